@@ -1,7 +1,13 @@
+import base64
+import datetime
+import json
 from enum import Enum
 from config import SAMPLES_PER_PAGE
-from models import Source, User, db, Sample, likes_table, Metadata, Tag, TagCategory
-from sqlalchemy import func
+from models import Source, User, db, Sample, likes_table, tags_table, Metadata, Tag, TagCategory
+from sqlalchemy import func, and_, or_
+import counters
+import source_search
+from replica import reads_from_replica
 
 class SampleSort(Enum):
     LATEST = 0
@@ -9,85 +15,241 @@ class SampleSort(Enum):
     LIKED = 2
     NONE = 3
 
+def sort_from_name(name):
+    match name:
+        case "latest":
+            return SampleSort.LATEST
+        case "oldest":
+            return SampleSort.OLDEST
+        case "liked":
+            return SampleSort.LIKED
+        case _:
+            return SampleSort.NONE
+
 def _samples_public():
     return Sample.query.filter_by(is_public=True)
 
+@reads_from_replica
 def get_recent_samples():
     return _samples_public().order_by(Sample.upload_date.desc()).limit(8).all()
 
+@reads_from_replica
 def get_top_samples():
-    return (
-        _samples_public()
-        .outerjoin(likes_table, Sample.id == likes_table.c.sample_id)
-        .group_by(Sample.id)
-        .order_by(func.count(likes_table.c.user_id).desc())
-        .limit(8)
-        .all()
-    )
+    return _samples_public().order_by(Sample.like_count.desc(), Sample.id.desc()).limit(8).all()
 
+@reads_from_replica
 def get_samples(sort: SampleSort, index: int):
     index -= 1
     if sort is None:
-        return _samples_public().limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
+        return _samples_public().order_by(Sample.id.asc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
     match sort:
         case SampleSort.LATEST:
-            return _samples_public().order_by(Sample.upload_date.desc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
+            return _samples_public().order_by(Sample.upload_date.desc(), Sample.id.desc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
         case SampleSort.OLDEST:
-            return _samples_public().order_by(Sample.upload_date.asc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
+            return _samples_public().order_by(Sample.upload_date.asc(), Sample.id.asc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
         case SampleSort.LIKED:
-            return (
-            _samples_public()
-                .outerjoin(likes_table, Sample.id == likes_table.c.sample_id)
-                .group_by(Sample.id)
-                .order_by(func.count(likes_table.c.user_id).desc())
-                .limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
-            )
+            return _samples_public().order_by(Sample.like_count.desc(), Sample.id.desc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
         case _:
-            return _samples_public().limit(SAMPLES_PER_PAGE)
-        
+            return _samples_public().order_by(Sample.id.asc()).limit(SAMPLES_PER_PAGE).offset(SAMPLES_PER_PAGE * index)
+
+# cursor tokens are opaque to clients, they just hand back whatever "next" we gave them.
+def encode_cursor(sort: SampleSort, values):
+    raw = json.dumps({"s": sort.name, "v": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(sort: SampleSort, token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        cursor = json.loads(raw)
+        if cursor["s"] != sort.name:
+            raise ValueError("cursor was made for a different sort")
+        return cursor["v"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+def cursor_after(sort: SampleSort, sample):
+    """Builds the cursor that continues a listing right after the given sample."""
+    match sort:
+        case SampleSort.LATEST | SampleSort.OLDEST:
+            return encode_cursor(sort, [sample.upload_date.isoformat(), sample.id])
+        case SampleSort.LIKED:
+            return encode_cursor(sort, [sample.like_count, sample.id])
+        case _:
+            return encode_cursor(SampleSort.NONE, [sample.id])
+
+@reads_from_replica
+def get_samples_after(sort: SampleSort, after=None):
+    """Keyset paginated version of get_samples, returns (samples, next_cursor).
+
+    Rows are seeked to with a WHERE on the sort key instead of skipped with OFFSET,
+    so every page costs the same no matter how deep it is. next_cursor is None on the last page.
+    """
+    return _keyset_page(_samples_public(), sort, after)
+
+def _keyset_order(query, sort: SampleSort, after=None):
+    if sort is None:
+        sort = SampleSort.NONE
+    cursor = decode_cursor(sort, after) if after else None
+
+    match sort:
+        case SampleSort.LATEST | SampleSort.OLDEST:
+            if cursor:
+                upload_date = datetime.datetime.fromisoformat(cursor[0])
+                if sort is SampleSort.LATEST:
+                    query = query.filter(or_(Sample.upload_date < upload_date, and_(Sample.upload_date == upload_date, Sample.id < cursor[1])))
+                else:
+                    query = query.filter(or_(Sample.upload_date > upload_date, and_(Sample.upload_date == upload_date, Sample.id > cursor[1])))
+            if sort is SampleSort.LATEST:
+                query = query.order_by(Sample.upload_date.desc(), Sample.id.desc())
+            else:
+                query = query.order_by(Sample.upload_date.asc(), Sample.id.asc())
+        case SampleSort.LIKED:
+            if cursor:
+                query = query.filter(or_(Sample.like_count < cursor[0], and_(Sample.like_count == cursor[0], Sample.id < cursor[1])))
+            query = query.order_by(Sample.like_count.desc(), Sample.id.desc())
+        case _:
+            if cursor:
+                query = query.filter(Sample.id > cursor[0])
+            query = query.order_by(Sample.id.asc())
+    return query
+
+
+def _keyset_page(query, sort: SampleSort, after=None):
+    if sort is None:
+        sort = SampleSort.NONE
+    query = _keyset_order(query, sort, after)
+
+    # fetch one extra row so we know whether there's a next page without a COUNT
+    samples = query.limit(SAMPLES_PER_PAGE + 1).all()
+    has_next = len(samples) > SAMPLES_PER_PAGE
+    samples = samples[:SAMPLES_PER_PAGE]
+
+    next_cursor = None
+    if has_next:
+        next_cursor = cursor_after(sort, samples[-1])
+
+    return samples, next_cursor
+
+@reads_from_replica
 def get_metadata(sample_id):
     return Metadata.query.get(sample_id)
 
+@reads_from_replica
 def get_samples_len():
-    return _samples_public().count()
+    return counters.get("public")
+
+@reads_from_replica
+def get_sample_counts(scope):
+    """{id: public sample count} for every source, uploader or tag, read from the catalog counters."""
+    return counters.get_all(scope)
         
+@reads_from_replica
 def search_sources(query):
-    return (_samples_public()
-            .filter(Source.name.ilike(f"%{query}%"))
-            .outerjoin(Sample, (Source.id == Sample.source_id) & (Sample.is_public == True))
-            .group_by(Source.id)
-            .order_by(func.count(Sample.id).desc())
-            .limit(50)
-            .all())
+    return source_search.search(query)
 
+@reads_from_replica
 def get_source_info(source_id):
     return Source.query.get(source_id)
 
+@reads_from_replica
 def get_sample_info(sample_id):
     return Sample.query.get(sample_id)
 
+@reads_from_replica
 def get_user_info(uploader):
     return User.query.get(uploader)
 
+@reads_from_replica
+def get_usernames(user_ids):
+    """Maps each of the given user ids to its username in a single query."""
+    if not user_ids:
+        return {}
+    rows = db.session.query(User.id, User.username).filter(User.id.in_(set(user_ids))).all()
+    return {user_id: username for user_id, username in rows}
+
+@reads_from_replica
+def get_liked(user_id, sample_ids):
+    """The ids among sample_ids that the user has liked, in one query on the likes table."""
+    if not sample_ids:
+        return set()
+    return set(
+        db.session.scalars(
+            db.select(likes_table.c.sample_id).where(
+                likes_table.c.user_id == user_id, likes_table.c.sample_id.in_(sample_ids)
+            )
+        )
+    )
+
+@reads_from_replica
+def get_tag_names(sample_ids):
+    """Maps each of the given sample ids to a list of its tag names in a single query."""
+    tag_names = {sample_id: [] for sample_id in sample_ids}
+    if not sample_ids:
+        return tag_names
+    rows = (
+        db.session.query(tags_table.c.sample_id, Tag.name)
+        .join(Tag, Tag.id == tags_table.c.tag_id)
+        .filter(tags_table.c.sample_id.in_(set(sample_ids)))
+        .order_by(Tag.name)
+        .all()
+    )
+    for sample_id, name in rows:
+        tag_names[sample_id].append(name)
+    return tag_names
+
+@reads_from_replica
 def get_user_samples(user_id, viewer_id=None, is_admin=False):
     if is_admin or (viewer_id is not None and user_id == viewer_id):
         return Sample.query.filter_by(uploader=user_id).order_by(Sample.upload_date.desc()).all()
     return Sample.query.filter_by(uploader=user_id, is_public=True).order_by(Sample.upload_date.desc()).all()
 
+@reads_from_replica
 def get_tags():
     return Tag.query.all()
 
+@reads_from_replica
 def get_tag_categories():
     return TagCategory.query.order_by(TagCategory.id).all()
 
-def search_samples(query):
-    tags = list(filter(None, query.split(',')))
+@reads_from_replica
+def search_samples(query, sort=SampleSort.LATEST, after=None, paginate=True):
+    """Tag search, returns (samples, next_cursor, total).
+
+    With paginate=False every match is returned in sort order and next_cursor is None.
+
+    The query is a comma separated list of tag names, a leading "-" excludes a tag.
+    Names are resolved to ids up front, then the AND/NOT is done on the tags table,
+    whose primary key leads with tag_id, so each term is an index range scan.
+    """
+    terms = [term.strip() for term in query.split(",")]
+    include = {term for term in terms if term and not term.startswith("-")}
+    exclude = {term[1:] for term in terms if term.startswith("-") and len(term) > 1}
+
+    tag_ids = dict(
+        db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(include | exclude)).all()
+    ) if include or exclude else {}
+
+    # a tag nobody has used can't match anything
+    if not include <= tag_ids.keys():
+        return [], None, 0
+
     query_results = _samples_public()
-    if tags is None:
-        return query_results.all()
-    for tag in tags:
-        if tag.startswith("-"):
-            query_results = query_results.filter(~Sample.tags.any(Tag.name == tag[1:]))
-        else:
-            query_results = query_results.filter(Sample.tags.any(Tag.name == tag))
-    return query_results.all()
+    if include:
+        matching = (
+            db.session.query(tags_table.c.sample_id)
+            .filter(tags_table.c.tag_id.in_([tag_ids[name] for name in include]))
+            .group_by(tags_table.c.sample_id)
+            .having(func.count() == len(include))
+        )
+        query_results = query_results.filter(Sample.id.in_(matching))
+    excluded_ids = [tag_ids[name] for name in exclude if name in tag_ids]
+    if excluded_ids:
+        excluded = db.session.query(tags_table.c.sample_id).filter(tags_table.c.tag_id.in_(excluded_ids))
+        query_results = query_results.filter(~Sample.id.in_(excluded))
+
+    if not paginate:
+        samples = _keyset_order(query_results, sort).all()
+        return samples, None, len(samples)
+    total = query_results.order_by(None).count()
+    samples, next_cursor = _keyset_page(query_results, sort, after)
+    return samples, next_cursor, total
@@ -10,21 +10,37 @@ from flask_login import (
 from flask_migrate import Migrate
 from flask_moment import Moment
 
-from config import VERSION
-from models import db, User
+from config import VERSION, MB_UPLOAD_LIMIT
+from models import db, bcrypt, User, Sample
 from mail import mail
+from ingest import UploadRequest
+from utils import recount_likes, hash_file, find_near_duplicates
+import auth
+import click
+import counters
+import export
+import jobs
+import source_search
+import media
+import metrics
+import profiler
+import replica
+import wiki
 import datetime
+import os
 
 from blueprints.main_routes import main_bp
 from blueprints.wiki_routes import wiki_bp
 from blueprints.api_routes import api_bp
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config.from_pyfile("config.py")
 app.jinja_env.add_extension("jinja2.ext.loopcontrols")
 version = VERSION
 
 db.init_app(app)
+bcrypt.init_app(app)
 mail.init_app(app)
 migrate = Migrate(app, db)
 moment = Moment(app)
@@ -33,6 +49,12 @@ app.register_blueprint(main_bp)
 app.register_blueprint(wiki_bp)
 app.register_blueprint(api_bp)
 
+media.init_app(app)
+metrics.init_app(app)
+profiler.init_app(app)
+replica.init_app(app)
+wiki.init_app(app)
+
 login_manager = LoginManager(app)
 login_manager.login_view = (
     "main.login"
@@ -47,19 +69,106 @@ def inject_global_data():
     }
 
 
+@app.before_request
+def start_job_workers():
+    jobs.start_workers(app)
+
+
 @app.errorhandler(404)
 def page_not_found(e):
-    return render_template("404.html", title="YTPMV Sample Database")
+    return render_template("404.html", title="YTPMV Sample Database"), 404
 
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    return jsonify({"error": "One or more of your sample(s) exceeded the file limit. Max supported filesize is 10MB per file."}), 400
+    return jsonify({"error": f"One or more of your sample(s) exceeded the file limit. Max supported filesize is {MB_UPLOAD_LIMIT}MB per file."}), 400
+
+
+@app.errorhandler(415)
+def unsupported_media_type(error):
+    return jsonify({"error": "There is an error one of your files. Please make sure it is a valid .mp4 file."}), 400
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return auth.load_user(user_id)
+
+
+@app.cli.command("recount-likes")
+def recount_likes_command():
+    """Recompute Sample.like_count from the likes table."""
+    print(f"Fixed like counts on {recount_likes()} sample(s).")
+
+
+@app.cli.command("reconcile-counters")
+def reconcile_counters_command():
+    """Recount the public sample counters (total, per source, uploader and tag)."""
+    print(f"Fixed {counters.reconcile()} drifted counter(s).")
+
+
+@app.cli.command("make-thumbnails")
+def make_thumbnails_command():
+    """Queue thumbnail jobs for samples that are missing their small grid thumbnail."""
+    queued = 0
+    for sample in Sample.query.all():
+        if not os.path.exists(os.path.join("static/media/thumbs", sample.small_thumbnail_filename)):
+            jobs.enqueue("thumbnail", sample.id, commit=False)
+            queued += 1
+    db.session.commit()
+    print(f"Queued thumbnails for {queued} sample(s).")
+
+
+@app.cli.command("hash-samples")
+def hash_samples_command():
+    """Fill in content_hash for samples uploaded before files were stored by hash."""
+    hashed = 0
+    for sample in Sample.query.filter(Sample.content_hash.is_(None)).all():
+        path = os.path.join("static/media/samps", sample.stored_as)
+        if os.path.exists(path):
+            sample.content_hash = hash_file(path)
+            hashed += 1
+    db.session.commit()
+    print(f"Hashed {hashed} sample(s).")
+
+
+@app.cli.command("near-duplicates")
+@click.option("--distance", default=6, help="Max number of differing bits between two thumbnail hashes.")
+def near_duplicates_command(distance):
+    """List groups of samples that look like the same clip."""
+    for group in find_near_duplicates(distance):
+        print(", ".join(f"{sample.id} ({sample.filename})" for sample in group))
+
+
+@app.cli.command("run-jobs")
+@click.option("--workers", default=os.cpu_count() or 2, show_default=True, help="Jobs run at once.")
+def run_jobs_command(workers):
+    """Run background jobs in the foreground, for setups with job_workers = 0."""
+    # this process is the host's whole pool, the extra threads are the same as a web worker's
+    jobs.start_workers(app, workers - 1)
+    jobs.work(app)
+
+
+@app.cli.command("export-catalog")
+@click.option("--since", default=None, help="Only samples changed at or after this ISO 8601 timestamp.")
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the output.")
+@click.option("-o", "--output", type=click.File("wb"), default="-", help="File to write to, stdout by default.")
+def export_catalog_command(since, compress, output):
+    """Write every public sample with its tags, source, uploader and metadata as NDJSON."""
+    try:
+        since = export.parse_since(since) if since else None
+    except ValueError:
+        raise click.BadParameter("must be an ISO 8601 timestamp", param_hint="--since")
+    chunks = export.ndjson_chunks(since)
+    if compress:
+        chunks = export.gzip_chunks(chunks)
+    for chunk in chunks:
+        output.write(chunk)
+
+
+@app.cli.command("build-wiki")
+def build_wiki_command():
+    """Render the wiki pages and changelogs to static/wiki/rendered for deployment."""
+    print(f"Rendered {wiki.build()} pages to {wiki.PREBUILT_DIR}.")
 
 
 if __name__ == "__main__":
@@ -70,3 +179,6 @@ with app.app_context():
     db.session.commit()
 
     users = User.query.all()
+
+source_search.init_app(app)
+counters.init_app(app)
@@ -0,0 +1,90 @@
+from sqlalchemy import event, func, or_
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+import cache
+from config import BCRYPT_LOG_ROUNDS, USER_CACHE_TTL
+from models import User, db
+
+# what the user loader keeps in the cache, the password hash stays out of it
+CACHED_COLUMNS = ("id", "email", "username", "join_date", "is_admin", "is_uploader", "is_verified")
+# columns whose change has to reach every worker before the cache entry would expire on its own
+WATCHED_COLUMNS = ("email", "username", "is_admin", "is_uploader", "is_verified")
+
+
+def _hash_rounds(password_hash):
+    # bcrypt hashes look like $2b$12$..., the second field is the cost
+    try:
+        return int(password_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def authenticate(login_name, password):
+    """Returns the user with that email or username if the password matches, otherwise None.
+
+    One query on the lowercased columns and at most one bcrypt check. A hash made with
+    a different cost than bcrypt_log_rounds is replaced with a new one on the way in.
+    """
+    login_name = login_name.lower()
+    users = User.query.filter(or_(func.lower(User.email) == login_name, func.lower(User.username) == login_name)).all()
+    if not users:
+        return None
+    # an email match wins, like it did when email was tried first
+    user = next((user for user in users if user.email and user.email.lower() == login_name), users[0])
+    if not user.check_password(password):
+        return None
+
+    if _hash_rounds(user.password_hash) != BCRYPT_LOG_ROUNDS:
+        user.set_password(password)
+        db.session.commit()
+    return user
+
+
+def _user_values(user_id):
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    return {column: getattr(user, column) for column in CACHED_COLUMNS}
+
+
+def load_user(user_id):
+    """The flask-login user loader, answered from the cache for up to user_cache_ttl seconds.
+
+    The cached row is attached to the session as-is, without a query, so relationships and
+    identity checks like `current_user in sample.likes` keep working.
+    """
+    user_id = int(user_id)
+    if USER_CACHE_TTL <= 0:
+        values = _user_values(user_id)
+    else:
+        values = cache.cached(f"user.{user_id}", "row", lambda: _user_values(user_id), USER_CACHE_TTL, group="users")
+    if values is None:
+        return None
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    # only reaches every worker with a shared cache backend, see user_cache_ttl
+    if USER_CACHE_TTL > 0:
+        cache.invalidate(f"user.{user_id}", group="users")
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, target):
+    # remembered until the commit, so another request can't cache the old row again in between
+    state = db.inspect(target)
+    if any(state.attrs[column].history.has_changes() for column in WATCHED_COLUMNS):
+        state.session.info.setdefault("changed_users", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    for user_id in session.info.pop("changed_users", ()):
+        invalidate_user(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_users", None)
@@ -0,0 +1,11 @@
+"""Reproducible benchmarks against a generated catalog.
+
+    YTPMVSD_DATABASE_URL=sqlite:////tmp/bench.sqlite python -m bench generate --seed 1
+    YTPMVSD_DATABASE_URL=sqlite:////tmp/bench.sqlite python -m bench run -o results.json --baseline baseline.json
+    python -m bench compare baseline.json results.json
+    YTPMVSD_DATABASE_URL=sqlite:////tmp/bench.sqlite python -m bench explain
+
+Run it from the repository root, like `flask run`, and always against a database of its own:
+generate refuses to add to one that already has samples. Set YTPMVSD_DATABASE_URL to a
+postgresql:// URL to benchmark against Postgres instead.
+"""
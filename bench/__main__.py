@@ -0,0 +1,85 @@
+import argparse
+import json
+import sys
+
+import bench
+from bench import catalog
+from bench.compare import compare
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=bench.__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Fill the (empty) database with a synthetic catalog.")
+    generate.add_argument("--seed", type=int, default=0)
+    for name, default in catalog.DEFAULTS.items():
+        generate.add_argument(f"--{name}", type=int, default=default)
+
+    run = commands.add_parser("run", help="Time the api functions, routes and media processing.")
+    run.add_argument("-o", "--output", help="Write the results to this JSON file.")
+    run.add_argument("--baseline", help="Compare against the results in this JSON file.")
+    run.add_argument("--repeat", type=int, default=5, help="Timed runs per benchmark.")
+    run.add_argument("--only", help="Only run benchmarks whose name contains this.")
+    run.add_argument("--no-media", action="store_true", help="Skip the ffmpeg benchmarks.")
+    run.add_argument("--tolerance", type=float, default=0.15, help="How much slower than the baseline still passes.")
+
+    explain = commands.add_parser("explain", help="Fail if an api query's plan falls back to a full table scan.")
+    explain.add_argument("--only", help="Only check benchmarks whose name contains this.")
+
+    compare_parser = commands.add_parser("compare", help="Compare two results files.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--tolerance", type=float, default=0.15)
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+        return _report(baseline, results, args.tolerance)
+
+    # the app reads config.toml and connects when it's imported, so only commands that need it pay for that
+    from app import app
+    from bench import suite
+
+    if args.command == "generate":
+        sizes = {name: getattr(args, name) for name in catalog.DEFAULTS}
+        with app.app_context():
+            made = catalog.generate(seed=args.seed, **sizes)
+        print(", ".join(f"{count} {name}" for name, count in made.items()))
+        return 0
+
+    if args.command == "explain":
+        from bench import plans
+
+        failures = plans.check(app, only=args.only)
+        if failures:
+            print(f"{len(failures)} api function(s) scan a whole table: {', '.join(failures)}")
+            return 1
+        return 0
+
+    results = suite.run(app, repeat=args.repeat, media=not args.no_media, only=args.only)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            return _report(json.load(f), results, args.tolerance)
+    return 0
+
+
+def _report(baseline, results, tolerance):
+    lines, regressions = compare(baseline, results, tolerance)
+    print("\n".join(lines))
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import datetime
+import random
+from collections import Counter
+
+from sqlalchemy import bindparam, insert, update
+
+import counters
+import source_search
+from models import Metadata, Sample, Source, Tag, TagCategory, User, bcrypt, db, likes_table, tags_table
+
+# the default catalog, roughly what the site would look like after years of uploads
+DEFAULTS = {
+    "samples": 100_000,
+    "likes": 1_000_000,
+    "tags": 5_000,
+    "sources": 20_000,
+    "users": 2_000,
+}
+# used when the database has no tag categories yet, the last one is where edits put new tags
+CATEGORIES = [
+    ("General", "ffffff"),
+    ("Instrument", "e0a030"),
+    ("Voice", "40a0e0"),
+    ("Genre", "a060e0"),
+    ("Uncategorized", "999999"),
+]
+# share of samples that are public, have a source, and the most tags one sample gets
+PUBLIC_SHARE = 0.9
+SOURCE_SHARE = 0.7
+MAX_TAGS = 8
+RESOLUTIONS = [(1920, 1080, "16:9"), (1280, 720, "16:9"), (640, 480, "4:3"), (480, 360, "4:3"), (1080, 1080, "1:1")]
+FRAMERATES = [23.976, 24.0, 25.0, 29.97, 30.0, 60.0]
+START_DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+BATCH_SIZE = 10_000
+
+
+def _skewed(rng, count, power=2.0):
+    # 0 is the most popular index, a bigger power concentrates more picks at the start
+    return min(int(count * rng.random() ** power), count - 1)
+
+
+def _insert(model, rows):
+    ids = []
+    for start in range(0, len(rows), BATCH_SIZE):
+        ids.extend(db.session.scalars(
+            insert(model).returning(model.id, sort_by_parameter_order=True),
+            rows[start:start + BATCH_SIZE],
+        ))
+    return ids
+
+
+def _insert_rows(table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(insert(table), rows[start:start + BATCH_SIZE])
+
+
+def _likes(rng, user_ids, sample_ids, total):
+    # a few heavy users like a lot, most like a little, and popular samples collect most of the likes
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(len(user_ids))]
+    scale = total / sum(weights)
+    cap = len(sample_ids) // 2
+    for user_id, weight in zip(user_ids, weights):
+        wanted = min(round(weight * scale), cap)
+        liked = set()
+        while len(liked) < wanted:
+            if rng.random() < 0.5:
+                liked.add(sample_ids[_skewed(rng, len(sample_ids), 3)])
+            else:
+                liked.add(rng.choice(sample_ids))
+        yield from ({"user_id": user_id, "sample_id": sample_id} for sample_id in sorted(liked))
+
+
+def generate(seed=0, progress=print, **sizes):
+    """Fills an empty database with a synthetic catalog, the same one every time for the same seed and sizes.
+
+    sizes override DEFAULTS (samples, likes, tags, sources, users). Returns the number of rows made of each.
+    """
+    sizes = {**DEFAULTS, **sizes}
+    if db.session.query(Sample.id).first() is not None:
+        raise ValueError("The database already has samples, generate into an empty one")
+    rng = random.Random(seed)
+
+    progress(f"Users: {sizes['users']}")
+    # one hash for everyone, bcrypt per user would take longer than the rest of the catalog
+    password_hash = bcrypt.generate_password_hash("bench").decode("utf-8")
+    user_ids = _insert(User, [
+        {
+            "username": f"bench_user_{i}",
+            "email": f"bench_user_{i}@example.com",
+            "password_hash": password_hash,
+            "join_date": START_DATE + datetime.timedelta(days=i % 1500),
+            "is_verified": True,
+            "is_uploader": i % 10 == 0,
+            "is_admin": i == 0,
+        }
+        for i in range(sizes["users"])
+    ])
+    uploader_ids = user_ids[::10] or user_ids
+
+    category_ids = [category_id for category_id, in db.session.query(TagCategory.id).order_by(TagCategory.id)]
+    if not category_ids:
+        category_ids = _insert(TagCategory, [{"name": name, "colour": colour} for name, colour in CATEGORIES])
+
+    progress(f"Tags: {sizes['tags']}, sources: {sizes['sources']}")
+    tag_ids = _insert(Tag, [
+        {"name": f"bench_tag_{i}", "description": None, "category_id": category_ids[_skewed(rng, len(category_ids), 1.5)]}
+        for i in range(sizes["tags"])
+    ])
+    source_ids = _insert(Source, [{"name": f"Bench Source {i}"} for i in range(sizes["sources"])])
+
+    progress(f"Samples: {sizes['samples']}")
+    span = (datetime.datetime(2026, 1, 1, tzinfo=datetime.UTC) - START_DATE).total_seconds()
+    offsets = sorted(rng.random() * span for _ in range(sizes["samples"]))
+    sample_rows = []
+    for i, offset in enumerate(offsets):
+        content_hash = f"{rng.getrandbits(256):064x}"
+        sample_rows.append({
+            "filename": f"bench_sample_{i}.mp4",
+            "stored_as": f"{content_hash}.mp4",
+            "upload_date": START_DATE + datetime.timedelta(seconds=offset),
+            "thumbnail_filename": f"{content_hash}.png",
+            "uploader": uploader_ids[_skewed(rng, len(uploader_ids))],
+            "source_id": source_ids[_skewed(rng, len(source_ids))] if source_ids and rng.random() < SOURCE_SHARE else None,
+            "is_public": rng.random() < PUBLIC_SHARE,
+            "like_count": 0,
+            "content_hash": content_hash,
+        })
+    sample_ids = _insert(Sample, sample_rows)
+
+    metadata_rows = []
+    tag_rows = []
+    for sample_id in sample_ids:
+        width, height, aspect_ratio = rng.choice(RESOLUTIONS)
+        metadata_rows.append({
+            "sample_id": sample_id,
+            "filesize": rng.randint(100_000, 50_000_000),
+            "width": width,
+            "height": height,
+            "aspect_ratio": aspect_ratio,
+            "framerate": rng.choice(FRAMERATES),
+            "codec": "h264",
+            "streams": None,
+        })
+        if tag_ids:
+            sample_tags = {tag_ids[_skewed(rng, len(tag_ids), 3)] for _ in range(rng.randint(0, MAX_TAGS))}
+            tag_rows.extend({"tag_id": tag_id, "sample_id": sample_id} for tag_id in sample_tags)
+    _insert_rows(Metadata.__table__, metadata_rows)
+    _insert_rows(tags_table, tag_rows)
+
+    progress(f"Likes: {sizes['likes']}")
+    like_counts = Counter()
+    batch = []
+    for row in _likes(rng, user_ids, sample_ids, sizes["likes"]) if sample_ids else ():
+        batch.append(row)
+        like_counts[row["sample_id"]] += 1
+        if len(batch) == BATCH_SIZE:
+            _insert_rows(likes_table, batch)
+            batch = []
+    _insert_rows(likes_table, batch)
+
+    progress("Counting likes and samples")
+    # counted along the way, recount_likes() would run a subquery per sample
+    counts = [{"id_": sample_id, "count": count} for sample_id, count in like_counts.items()]
+    for start in range(0, len(counts), BATCH_SIZE):
+        db.session.execute(
+            update(Sample.__table__).where(Sample.id == bindparam("id_")).values(like_count=bindparam("count")),
+            counts[start:start + BATCH_SIZE],
+        )
+    db.session.commit()
+    counters.reconcile()
+    source_search.invalidate()
+    return {
+        "samples": len(sample_ids),
+        "likes": like_counts.total(),
+        "tags": len(tag_ids),
+        "sources": len(source_ids),
+        "users": len(user_ids),
+        "sample_tags": len(tag_rows),
+    }
@@ -0,0 +1,33 @@
+def compare(baseline, current, tolerance=0.15):
+    """Lines comparing two run() results, and the names of the benchmarks that got slower or run more queries.
+
+    A benchmark is slower when its median grew by more than tolerance (0.15 = 15%).
+    """
+    lines = []
+    for key in ("dialect", "catalog"):
+        if baseline["meta"].get(key) != current["meta"].get(key):
+            lines.append(f"warning: {key} differs, {baseline['meta'].get(key)} vs {current['meta'].get(key)}")
+
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            lines.append(f"{'new':>8}  {name}: {result['median_ms']} ms")
+            continue
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else 1.0
+        status = ""
+        if ratio > 1 + tolerance:
+            status = "slower"
+        elif ratio < 1 - tolerance:
+            status = "faster"
+        if result["queries"] > before["queries"]:
+            status = "queries" if not status else f"{status}, queries"
+        if "slower" in status or "queries" in status:
+            regressions.append(name)
+        lines.append(
+            f"{ratio:>7.2f}x  {name}: {before['median_ms']} -> {result['median_ms']} ms, "
+            f"{before['queries']} -> {result['queries']} queries{'  ' + status if status else ''}"
+        )
+    for name in baseline["results"].keys() - current["results"].keys():
+        lines.append(f"{'gone':>8}  {name}")
+    return lines, regressions
@@ -0,0 +1,88 @@
+import json
+import re
+
+from sqlalchemy import event
+
+from bench import suite
+from models import db
+
+# tables small enough, or read whole on purpose, that a full scan is the right plan
+SCAN_OK = {"tag_category", "alembic_version"}
+# benchmarks that read a whole table by design
+EXPECTED_SCANS = {
+    "api.get_tags": {"tag"},
+    # without pg_trgm, source search loads every source into its in-memory index
+    "api.search_sources": {"source"},
+}
+
+
+def _capture(fn):
+    """Runs fn and returns the (statement, parameters) of every query it ran."""
+    statements = []
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before)
+        db.session.remove()
+    return statements
+
+
+def _sqlite_scans(connection, statement, parameters):
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    lines = [row[-1] for row in rows]
+    # "SCAN sample" reads every row. "SCAN sample USING INDEX ..." walks an index in sort order,
+    # which is only cut short when there's a LIMIT, without one it reads every row as well
+    pattern = r"SCAN (\w+)(?: AS \w+)?" if re.search(r"\bLIMIT\b", statement) else r"SCAN (\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX \w+)?"
+    scans = {match.group(1) for line in lines if (match := re.fullmatch(pattern, line))}
+    return scans, lines
+
+
+def _postgres_scans(connection, statement, parameters):
+    plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scans = set()
+    nodes = [plan[0]["Plan"]]
+    while nodes:
+        node = nodes.pop()
+        if node["Node Type"] == "Seq Scan":
+            scans.add(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    return scans, json.dumps(plan, indent=1).splitlines()
+
+
+def check(app, only=None, progress=print):
+    """EXPLAINs every query of every api benchmark and returns the names of the ones that fall back to a full
+    table scan. Only meaningful on a generated catalog, on a handful of rows every planner prefers a scan.
+    """
+    with app.app_context():
+        explain = {"sqlite": _sqlite_scans, "postgresql": _postgres_scans}.get(db.engine.dialect.name)
+        if explain is None:
+            raise ValueError(f"Can't read {db.engine.dialect.name} plans")
+        benchmarks = suite.api_benchmarks(suite._fixtures())
+
+        failures = []
+        with db.engine.connect() as connection:
+            for name, fn in benchmarks.items():
+                if only and only not in name:
+                    continue
+                allowed = SCAN_OK | EXPECTED_SCANS.get(name, set())
+                statements = _capture(fn)
+                bad = False
+                for statement, parameters in statements:
+                    scans, plan = explain(connection, statement, parameters)
+                    scans -= allowed
+                    if scans:
+                        bad = True
+                        progress(f"{name}: full scan of {', '.join(sorted(scans))}\n  {statement}\n  " + "\n  ".join(plan))
+                if bad:
+                    failures.append(name)
+                else:
+                    progress(f"{name}: ok ({len(statements)} queries)")
+    return failures
@@ -0,0 +1,262 @@
+import datetime
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import ffmpeg
+from sqlalchemy import func
+
+import api
+import cache
+import profiler
+import source_search
+import utils
+from api import SampleSort
+from config import SAMPLES_PER_PAGE
+from encoder import reencode_video
+from models import Sample, Source, Tag, TagCategory, User, db, likes_table, tags_table
+
+# clips made for the media benchmarks: name -> ffmpeg output options. h264 gets remuxed, mpeg4 reencoded
+CLIPS = {
+    "h264": {"vcodec": "libx264", "acodec": "aac", "pix_fmt": "yuv420p"},
+    "mpeg4": {"vcodec": "mpeg4", "acodec": "aac"},
+}
+CLIP_SECONDS = 3
+CLIP_SIZE = "640x360"
+
+
+def _reset():
+    # the in-process caches would answer every run after the first from memory, so every timed
+    # run starts cold. "home" is the only page cache namespace
+    cache.invalidate("home")
+    source_search.invalidate()
+    utils._probe_cache.clear()
+
+
+def _timings(fn, repeat, cold):
+    timings = []
+    for _ in range(repeat):
+        if cold:
+            _reset()
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+        db.session.remove()
+    return timings
+
+
+def _measure(fn, repeat, warm=True):
+    """Cold timings (median_ms and co.) with the app's caches emptied before every run, which is what's
+    compared against a baseline, and with warm the median when those caches are left as they are.
+    """
+    # one untimed run warms up connections, the session is cleared between runs so
+    # the identity map doesn't answer the next run's queries
+    fn()
+    db.session.remove()
+    _reset()
+    with profiler.collect() as records:
+        fn()
+    db.session.remove()
+    timings = _timings(fn, repeat, cold=True)
+    result = {
+        "median_ms": round(statistics.median(timings), 3),
+        "min_ms": round(min(timings), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "runs": repeat,
+        "queries": len(records),
+    }
+    if warm:
+        fn()
+        db.session.remove()
+        result["warm_median_ms"] = round(statistics.median(_timings(fn, repeat, cold=False)), 3)
+    return result
+
+
+def _fixtures():
+    """Ids and names for the benchmarks to ask about, picked the same way every time for the same catalog."""
+    public = Sample.query.filter_by(is_public=True)
+    total = public.count()
+    if not total:
+        raise ValueError("The database has no public samples, run `python -m bench generate` first")
+    middle = public.order_by(Sample.id).offset(total // 2).first()
+    deep_latest = public.order_by(Sample.upload_date.desc(), Sample.id.desc()).offset(total // 2).first()
+    deep_liked = public.order_by(Sample.like_count.desc(), Sample.id.desc()).offset(total // 2).first()
+    page = [sample.id for sample in api.get_samples(SampleSort.LATEST, 1)]
+    top_uploader = (
+        db.session.query(Sample.uploader).group_by(Sample.uploader).order_by(func.count().desc(), Sample.uploader).first()[0]
+    )
+    top_liker = (
+        db.session.query(likes_table.c.user_id).group_by(likes_table.c.user_id)
+        .order_by(func.count().desc(), likes_table.c.user_id).first()
+    )
+    top_tags = [
+        name for name, in db.session.query(Tag.name).join(tags_table, tags_table.c.tag_id == Tag.id)
+        .group_by(Tag.id, Tag.name).order_by(func.count().desc(), Tag.id).limit(3)
+    ]
+    source = (
+        db.session.query(Source).join(Sample, Sample.source_id == Source.id)
+        .group_by(Source.id).order_by(func.count().desc(), Source.id).first()
+    )
+    return {
+        "sample_id": middle.id,
+        "uploader_id": middle.uploader,
+        "page": page,
+        "deep_page": max(1, total // SAMPLES_PER_PAGE // 2),
+        "latest_cursor": api.cursor_after(SampleSort.LATEST, deep_latest),
+        "liked_cursor": api.cursor_after(SampleSort.LIKED, deep_liked),
+        "top_uploader": top_uploader,
+        "liker_id": top_liker[0] if top_liker else middle.uploader,
+        "top_tags": top_tags,
+        "source_id": source.id if source else None,
+        "source_query": source.name[:8] if source else "source",
+    }
+
+
+def api_benchmarks(f):
+    tag = f["top_tags"][0] if f["top_tags"] else ""
+    tags = ",".join(f["top_tags"][:2])
+    excluding = f"{tag},-{f['top_tags'][1]}" if len(f["top_tags"]) > 1 else tag
+    return {
+        "api.get_recent_samples": lambda: api.get_recent_samples(),
+        "api.get_top_samples": lambda: api.get_top_samples(),
+        "api.get_samples[latest,1]": lambda: api.get_samples(SampleSort.LATEST, 1).all(),
+        "api.get_samples[latest,deep]": lambda: api.get_samples(SampleSort.LATEST, f["deep_page"]).all(),
+        "api.get_samples[liked,deep]": lambda: api.get_samples(SampleSort.LIKED, f["deep_page"]).all(),
+        "api.get_samples_after[latest]": lambda: api.get_samples_after(SampleSort.LATEST),
+        "api.get_samples_after[latest,deep]": lambda: api.get_samples_after(SampleSort.LATEST, f["latest_cursor"]),
+        "api.get_samples_after[liked,deep]": lambda: api.get_samples_after(SampleSort.LIKED, f["liked_cursor"]),
+        "api.get_metadata": lambda: api.get_metadata(f["sample_id"]),
+        "api.get_samples_len": lambda: api.get_samples_len(),
+        "api.get_sample_counts[tag]": lambda: api.get_sample_counts("tag"),
+        "api.get_sample_counts[source]": lambda: api.get_sample_counts("source"),
+        "api.search_sources": lambda: api.search_sources(f["source_query"]),
+        "api.get_source_info": lambda: api.get_source_info(f["source_id"]),
+        "api.get_sample_info": lambda: api.get_sample_info(f["sample_id"]),
+        "api.get_user_info": lambda: api.get_user_info(f["uploader_id"]),
+        "api.get_usernames": lambda: api.get_usernames([f["uploader_id"], f["top_uploader"], f["liker_id"]]),
+        "api.get_liked": lambda: api.get_liked(f["liker_id"], f["page"]),
+        "api.get_tag_names": lambda: api.get_tag_names(f["page"]),
+        "api.get_user_samples": lambda: api.get_user_samples(f["top_uploader"]),
+        "api.get_tags": lambda: api.get_tags(),
+        "api.get_tag_categories": lambda: api.get_tag_categories(),
+        "api.search_samples[one]": lambda: api.search_samples(tag),
+        "api.search_samples[two]": lambda: api.search_samples(tags),
+        "api.search_samples[exclude]": lambda: api.search_samples(excluding),
+    }
+
+
+def route_benchmarks(f):
+    tag = f["top_tags"][0] if f["top_tags"] else ""
+    paths = [
+        "/",
+        "/samples/",
+        f"/samples/{f['deep_page']}/",
+        f"/sample/{f['sample_id']}/",
+        f"/user/{f['top_uploader']}/",
+        "/sources/",
+        f"/source/{f['source_id']}/",
+        "/tags/",
+        f"/search?q={tag}",
+        "/api/recent_samples",
+        "/api/top_samples",
+        "/api/samples/latest/1",
+        f"/api/samples/latest?after={f['latest_cursor']}",
+        f"/api/sample/{f['sample_id']}",
+        f"/api/search_samples?q={tag}",
+        f"/api/search_sources?q={f['source_query']}",
+        "/api/samples_len",
+    ]
+    return {f"GET {path}": path for path in paths}
+
+
+def _make_clip(directory, name, options):
+    path = os.path.join(directory, f"{name}.mp4")
+    video = ffmpeg.input(f"testsrc=duration={CLIP_SECONDS}:size={CLIP_SIZE}:rate=30", f="lavfi")
+    audio = ffmpeg.input(f"sine=frequency=440:duration={CLIP_SECONDS}", f="lavfi")
+    ffmpeg.output(video, audio, path, **options).run(quiet=True, overwrite_output=True)
+    return path
+
+
+def media_benchmarks(directory, progress=print):
+    """check_video, create_thumbnail and reencode_video on each of the CLIPS that ffmpeg here can make."""
+    benchmarks = {}
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        progress("No ffmpeg/ffprobe on the PATH, skipping the media benchmarks")
+        return benchmarks
+    for name, options in CLIPS.items():
+        try:
+            clip = _make_clip(directory, name, options)
+        except ffmpeg.Error:
+            progress(f"ffmpeg can't make the {name} clip, skipping it")
+            continue
+
+        def check(clip=clip):
+            utils.check_video(clip)
+
+        def thumbnail(clip=clip, name=name):
+            utils.create_thumbnail(clip, os.path.join(directory, f"{name}.png"), os.path.join(directory, f"{name}_small.webp"))
+
+        benchmarks[f"media.check_video[{name}]"] = check
+        benchmarks[f"media.create_thumbnail[{name}]"] = thumbnail
+        benchmarks[f"media.reencode_video[{name}]"] = lambda clip=clip, name=name: reencode_video(
+            clip, os.path.join(directory, f"{name}_out.mp4")
+        )
+    return benchmarks
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _catalog():
+    return {
+        "samples": db.session.query(func.count(Sample.id)).scalar(),
+        "likes": db.session.query(func.count()).select_from(likes_table).scalar(),
+        "tags": db.session.query(func.count(Tag.id)).scalar(),
+        "tag_categories": db.session.query(func.count(TagCategory.id)).scalar(),
+        "sources": db.session.query(func.count(Source.id)).scalar(),
+        "users": db.session.query(func.count(User.id)).scalar(),
+    }
+
+
+def run(app, repeat=5, media=True, only=None, progress=print):
+    """Times every benchmark against the app's database and returns the results as a JSON-ready dict.
+
+    only limits the run to benchmarks whose name contains it.
+    """
+    with app.app_context():
+        fixtures = _fixtures()
+        meta = {
+            "created": datetime.datetime.now(datetime.UTC).isoformat(),
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "dialect": db.engine.dialect.name,
+            "catalog": _catalog(),
+            "repeat": repeat,
+        }
+        benchmarks = api_benchmarks(fixtures)
+        client = app.test_client()
+        for name, path in route_benchmarks(fixtures).items():
+            benchmarks[name] = lambda path=path: client.get(path).close()
+
+        with tempfile.TemporaryDirectory(prefix="ytpmvsd-bench-") as directory:
+            if media:
+                os.makedirs("static/media/samps", exist_ok=True)
+                benchmarks.update(media_benchmarks(directory, progress))
+
+            results = {}
+            for name, fn in benchmarks.items():
+                if only and only not in name:
+                    continue
+                # a warm media run is the same ffmpeg work again, only the api and routes have caches in front
+                results[name] = _measure(fn, repeat, warm=not name.startswith("media."))
+                warm = f" ({results[name]['warm_median_ms']} ms warm)" if "warm_median_ms" in results[name] else ""
+                progress(f"{name}: {results[name]['median_ms']} ms{warm}, {results[name]['queries']} queries")
+    return {"meta": meta, "results": results}
@@ -1,46 +1,70 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from flask_login import current_user
 import api
+import cache
+import export
+import jobs
 import math
+from utils import err_sanitize
 from config import SAMPLES_PER_PAGE
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 
+# most sample ids /api/liked takes in one request
+LIKED_LOOKUP_LIMIT = 200
+
+def samples_jsonify(samples):
+    # serializes a whole page at once so the number of queries doesn't grow with the page size:
+    # uploader names and tag names are each fetched with one IN query, likes and source come off the row.
+    samples = list(samples)
+    usernames = api.get_usernames([sample.uploader for sample in samples])
+    tag_names = api.get_tag_names([sample.id for sample in samples])
+    return [
+        {
+            "id": sample.id,
+            "filename": sample.filename,
+            "tags": tag_names[sample.id],
+            "upload_date": sample.upload_date,
+            "thumbnail_filename": sample.thumbnail_filename,
+            "uploader": usernames.get(sample.uploader),
+            "likes": sample.like_count,
+            "source": sample.source_id if sample.source_id is not None else -1,
+            "stored_as": sample.stored_as,
+        }
+        for sample in samples
+    ]
+
 def sample_jsonify(sample):
     if sample is None:
         return {}
-    uploader_name = api.get_user_info(sample.uploader).username
-    source_id = -1
-    if sample.source is not None:
-        source_id = sample.source.id
-    return {"id":sample.id,"filename":sample.filename,"tags":sample.tags,"upload_date":sample.upload_date,"thumbnail_filename":sample.thumbnail_filename,"uploader":uploader_name,"likes":len(sample.likes), "source": source_id, "stored_as": sample.stored_as}
+    return samples_jsonify([sample])[0]
 
 @api_bp.route("/recent_samples")
 def api_recent_samples():
-    res = api.get_recent_samples()
-    samples = list(map(lambda f: sample_jsonify(f), res))
-    return jsonify(samples)
+    res = cache.cached("home", "recent_api", lambda: samples_jsonify(api.get_recent_samples()))
+    return jsonify(res)
 
 @api_bp.route("/top_samples")
 def api_top_samples():
-    res = api.get_top_samples()
-    samples = list(map(lambda f: sample_jsonify(f), res))
-    return jsonify(samples)
+    res = cache.cached("home", "top_api", lambda: samples_jsonify(api.get_top_samples()))
+    return jsonify(res)
 
 @api_bp.route("/samples/<string:sort>/<int:index>")
 def api_samples(sort, index):
-    if sort == "latest":
-        res = api.get_samples(api.SampleSort.LATEST, index)
-    elif sort == "oldest":
-        res = api.get_samples(api.SampleSort.OLDEST, index)
-    elif sort == "liked":
-        res = api.get_samples(api.SampleSort.LIKED, index)
-    else:
-        res = api.get_samples(api.SampleSort.NONE, index)
-    return jsonify(list(map(lambda f: sample_jsonify(f),res)))
+    res = api.get_samples(api.sort_from_name(sort), index)
+    return jsonify(samples_jsonify(res))
 
+# passing ?after= (empty for the first page) switches to cursor pagination,
+# which returns {"samples": [...], "next": <cursor or null>} instead of a bare list.
 @api_bp.route("/samples/<string:sort>")
 def api_samples_base(sort):
-    return api_samples(sort, 1)
+    if "after" not in request.args:
+        return api_samples(sort, 1)
+    try:
+        res, next_cursor = api.get_samples_after(api.sort_from_name(sort), request.args.get("after"))
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
+    return jsonify({"samples": samples_jsonify(res), "next": next_cursor})
 
 @api_bp.route("/metadata/<int:sample_id>")
 def api_metadata(sample_id):
@@ -49,7 +73,7 @@ def api_metadata(sample_id):
 @api_bp.route("/search/<string:query>")
 def api_search_sources(query):
     res = api.search_sources(query)
-    return jsonify({"id":res.id,"name":res.name,"samples":res.samples})
+    return jsonify([{"id": s.id, "name": s.name, "samples": s.samples} for s in res])
 
 @api_bp.route("/source/<int:source_id>")
 def api_source_info(source_id):
@@ -68,12 +92,22 @@ def api_sample_info(sample_id):
 def api_samples_len():
     return jsonify({"len": int(math.ceil(api.get_samples_len() / SAMPLES_PER_PAGE))})
 
+# without ?after= this is the list of every match it always was. ?after= (empty for the first page)
+# switches to {"samples": [...], "next": cursor or null, "total": n}, a page at a time like /samples/<sort>
 @api_bp.route("/search_samples")
 def api_search_samples():
     query = request.args.get("q", "")
-    samples = api.search_samples(query)
+    sort = api.sort_from_name(request.args.get("sort", "latest"))
+    paginate = "after" in request.args
+    try:
+        samples, next_cursor, total = api.search_samples(query, sort, request.args.get("after"), paginate=paginate)
+    except ValueError as ex:
+        return jsonify({"error": str(ex)}), 400
 
-    return jsonify([{"id": s.id, "name": s.filename} for s in samples])
+    results = [{"id": s.id, "name": s.filename} for s in samples]
+    if not paginate:
+        return jsonify(results)
+    return jsonify({"samples": results, "next": next_cursor, "total": total})
 
 @api_bp.route("/search_sources")
 def search_sources():
@@ -81,3 +115,51 @@ def search_sources():
     sources = api.search_sources(query)
 
     return jsonify([{"id": s.id, "name": s.name} for s in sources])
+
+@api_bp.route("/jobs/<int:job_id>")
+def api_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    res = jobs.job_jsonify(job)
+    if res["error"]:
+        res["error"] = err_sanitize(res["error"])
+    return jsonify(res)
+
+# ?ids=1,2,3 -> {"liked": [...]}, the ids of a page of samples that the logged in user has liked.
+# one query for the whole page, anonymous users just get an empty list.
+@api_bp.route("/liked")
+def api_liked():
+    try:
+        sample_ids = [int(sample_id) for sample_id in request.args.get("ids", "").split(",") if sample_id]
+    except ValueError:
+        return jsonify({"error": "ids must be a comma separated list of sample ids"}), 400
+    if len(sample_ids) > LIKED_LOOKUP_LIMIT:
+        return jsonify({"error": f"At most {LIKED_LOOKUP_LIMIT} ids at a time"}), 400
+    if not current_user.is_authenticated:
+        return jsonify({"liked": []})
+    return jsonify({"liked": sorted(api.get_liked(current_user.id, sample_ids))})
+
+# the whole public catalog as NDJSON, streamed. ?since=<ISO timestamp> only includes samples changed
+# since then, ?gzip=1 compresses it into a catalog.ndjson.gz download.
+@api_bp.route("/export")
+def api_export():
+    since = None
+    if request.args.get("since"):
+        try:
+            since = export.parse_since(request.args["since"])
+        except ValueError:
+            return jsonify({"error": "since must be an ISO 8601 timestamp"}), 400
+
+    chunks = export.ndjson_chunks(since)
+    if request.args.get("gzip") in ("1", "true"):
+        return Response(
+            stream_with_context(export.gzip_chunks(chunks)),
+            mimetype="application/gzip",
+            headers={"Content-Disposition": "attachment; filename=catalog.ndjson.gz"},
+        )
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson")
+
+@api_bp.route("/cache_stats")
+def api_cache_stats():
+    return jsonify(cache.stats())
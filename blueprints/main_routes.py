@@ -2,34 +2,40 @@ import datetime
 import os
 import re
 import math
-import markdown
-from flask import Blueprint, render_template, request, redirect, session, url_for, jsonify, flash, send_file
+from flask import Blueprint, render_template, request, redirect, session, url_for, jsonify, flash
 from flask_login import login_required, current_user, login_user, logout_user
-from sqlalchemy import func
 
-from config import REQUIRE_USER_APPROVAL, VERSION, SAMPLES_PER_PAGE, USE_EMAIL_VERIFICATION
+from config import REQUIRE_USER_APPROVAL, VERSION, SAMPLES_PER_PAGE, USE_EMAIL_VERIFICATION, MAX_FILES_PER_UPLOAD
 from models import db, Sample, User, Source
-from utils import update_metadata
 from mail import generate_token, send_verification_email, confirm_token
 import api
+import auth
+import cache
+import media
 import samples
+import wiki
 
 main_bp = Blueprint("main", __name__)
 
+def _home_samples(res_samples):
+    # plain values, so the lists can be cached (and shared between workers) without an open session
+    return [
+        {
+            "id": sample.id,
+            "filename": sample.filename,
+            "thumbnail_filename": sample.thumbnail_filename,
+            "small_thumbnail_filename": sample.small_thumbnail_filename,
+            "upload_date": sample.upload_date,
+        }
+        for sample in res_samples
+    ]
+
 @main_bp.route("/")
 def home_page():
-    recent_samples = api.get_recent_samples()
-    top_samples = api.get_top_samples()
-
-    filepath = os.path.join("static/wiki/pages/changelogs", f"{VERSION}.md")
-
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            changelog_md = f.read()
-        changelog = markdown.markdown(changelog_md)
-    except FileNotFoundError:
-        print(f"Changelog {filepath} not found.")
-        changelog = None
+    # the lists are dropped from the cache whenever a sample is uploaded, published, liked, edited or deleted
+    recent_samples = cache.cached("home", "recent", lambda: _home_samples(api.get_recent_samples()))
+    top_samples = cache.cached("home", "top", lambda: _home_samples(api.get_top_samples()))
+    changelog = wiki.changelog(VERSION)
 
     return render_template(
         "home.html",
@@ -42,22 +48,28 @@ def home_page():
 
 @main_bp.route("/samples/<int:index>/")
 def samples_list(index):
-    sort = request.args.get("sort", "liked")
-
-    if sort == "latest":
-        res_samples = api.get_samples(api.SampleSort.LATEST, index)
-    elif sort == "oldest":
-        res_samples = api.get_samples(api.SampleSort.OLDEST, index)
-    elif sort == "liked":
-        res_samples = api.get_samples(api.SampleSort.LIKED, index)
-    else:
-        res_samples = api.get_samples(api.SampleSort.NONE, index)
+    sort = api.sort_from_name(request.args.get("sort", "liked"))
+    after = request.args.get("after")
+
+    # the "next page" link carries a cursor so walking forward doesn't get slower the deeper you go,
+    # jumping straight to a page number still falls back to an offset.
+    next_cursor = None
+    if after:
+        try:
+            res_samples, next_cursor = api.get_samples_after(sort, after)
+        except ValueError:
+            after = None
+    if not after:
+        res_samples = api.get_samples(sort, index).all()
+        if len(res_samples) == SAMPLES_PER_PAGE:
+            next_cursor = api.cursor_after(sort, res_samples[-1])
 
     return render_template(
         "samples.html",
         title="Samples - YTPMV Sample Database",
         samples=res_samples,
         index=index,
+        next_cursor=next_cursor,
         page_num = int(math.ceil(api.get_samples_len() / SAMPLES_PER_PAGE))
     )
 
@@ -78,10 +90,8 @@ def sample_page(sample_id):
 
     uploader = api.get_user_info(sample.uploader)
 
+    # filled in by the sample's metadata job, until then the page goes without
     metadata = api.get_metadata(sample.id)
-    if metadata is None:
-        update_metadata(sample_id)
-        metadata = api.get_metadata(sample.id)
 
     return render_template(
         "sample.html",
@@ -89,6 +99,7 @@ def sample_page(sample_id):
         sample=sample,
         uploader=uploader,
         metadata=metadata,
+        liked=current_user.is_authenticated and sample.id in api.get_liked(current_user.id, [sample.id]),
     )
 
 @main_bp.route("/sample/edit/<sample_id>/", methods=["GET", "POST"])
@@ -224,21 +235,23 @@ def batch_edit_samples(sample_ids):
         if source_id == "":
             source_id = None
 
+        # the whole batch is saved in one transaction, either every sample is updated or none is
+        edit_status = samples.edit_samples(
+            [(sample_item["sample_id"], sample_item["filename"], source_id, []) for sample_item in sample_data],
+            reencode,
+        )
+
         for sample_item in sample_data:
-            filename = sample_item["filename"]
             sample_id = sample_item["sample_id"]
-
-            edit_status = samples.edit_sample(sample_id, filename, source_id, [], reencode)
-
             session.pop(f"uploaded_sample_id_{sample_id}", None)
             session.pop(f"filename_{sample_id}", None)
             session.pop(f"thumbnail_{sample_id}", None)
             session.pop(f"stored_as_{sample_id}", None)
-            session.pop(f"force_reencode", None)
+        session.pop(f"force_reencode", None)
 
-            if edit_status:
-                flash("Failed to upload one or more sample(s). Please reencode or try another video.", "error")
-                return redirect(url_for("main.upload"))
+        if edit_status:
+            flash("Failed to upload one or more sample(s). Please reencode or try another video.", "error")
+            return redirect(url_for("main.upload"))
 
         return redirect(url_for("main.user_page", user_id=current_user.id))
 
@@ -257,15 +270,8 @@ def like_sample(sample_id):
     if not current_user.is_verified:
         return jsonify(success=False, message="Please verify your account to like samples.")
 
-    if current_user in sample.likes:
-        sample.likes.remove(current_user)
-        liked = False
-    else:
-        sample.likes.append(current_user)
-        liked = True
-
-    db.session.commit()
-    return jsonify(success=True, likes=len(sample.likes), liked=liked)
+    liked, likes = samples.toggle_like(sample.id, current_user.id)
+    return jsonify(success=True, likes=likes, liked=liked)
 
 @main_bp.route("/sample/delete/<int:sample_id>/", methods=["POST"])
 @login_required
@@ -276,14 +282,39 @@ def delete_sample(sample_id):
 
     return samples.delete_sample(sample_id)
 
+@main_bp.route("/sample/publish/<int:sample_id>/", methods=["POST"])
+@login_required
+def publish_sample(sample_id):
+    if not current_user.is_admin:
+        return jsonify({"message": "Access denied"}), 403
+
+    return samples.publish_sample(sample_id, request.form.get("public", "true") != "false")
+
 @main_bp.route("/sample/<int:sample_id>/download/")
 def download_sample(sample_id):
     sample = Sample.query.get_or_404(sample_id)
     if not sample.is_public:
         if not current_user.is_authenticated or (not current_user.is_admin and current_user.id != sample.uploader):
             return render_template("404.html", title="YTPMV Sample Database"), 404
-    file_path = os.path.join("static/media/samps", sample.stored_as)
-    return send_file(file_path, as_attachment=True, download_name=sample.filename)
+    return media.send_media(
+        os.path.join("samps", sample.stored_as),
+        download_name=sample.filename,
+        as_attachment=True,
+        content_hash=sample.content_hash,
+        public=sample.is_public,
+    )
+
+@main_bp.route("/sample/<int:sample_id>/stream/")
+def stream_sample(sample_id):
+    sample = Sample.query.get_or_404(sample_id)
+    if not sample.is_public:
+        if not current_user.is_authenticated or (not current_user.is_admin and current_user.id != sample.uploader):
+            return render_template("404.html", title="YTPMV Sample Database"), 404
+    return media.send_media(
+        os.path.join("samps", sample.stored_as),
+        content_hash=sample.content_hash,
+        public=sample.is_public,
+    )
 
 @main_bp.route("/user/<int:user_id>/")
 def user_page(user_id):
@@ -315,7 +346,7 @@ def all_sources():
     sources = Source.query.order_by(Source.name.asc()).all()
 
     return render_template(
-        "sources.html", title="Sources - YTPMV Sample Database", sources=sources
+        "sources.html", title="Sources - YTPMV Sample Database", sources=sources, sample_counts=api.get_sample_counts("source")
     )
 
 @main_bp.route("/source/<int:source_id>/")
@@ -335,13 +366,19 @@ def source_page(source_id):
 @main_bp.route("/search")
 def search_results():
     query = request.args.get("q", "")
+    sort = api.sort_from_name(request.args.get("sort", "latest"))
 
-    results = api.search_samples(query)
+    try:
+        results, next_cursor, total = api.search_samples(query, sort, request.args.get("after"))
+    except ValueError:
+        results, next_cursor, total = api.search_samples(query, sort)
 
     return render_template(
         "search.html",
         title="YTPMV Sample Database",
         samples=results,
+        next_cursor=next_cursor,
+        total=total,
     )
 
 @main_bp.route("/tags/")
@@ -359,6 +396,7 @@ def tags_list():
         title="Tags - YTPMV Sample Database",
         categories=categories,
         tags=grouped_tags,
+        sample_counts=api.get_sample_counts("tag"),
     )
 
 @main_bp.route("/upload/", methods=["GET", "POST"])
@@ -374,39 +412,43 @@ def upload():
         if len(files) == 0 or files[0].filename == "":
             return jsonify({"error": "No files selected"}), 400
 
-        if len(files) > 10:
+        if len(files) > MAX_FILES_PER_UPLOAD:
             return jsonify({"error": "Too many files"}), 400
 
-        for file in files:
-            try:
-                (sample_id, original_filename, timestamp, stored_as, force_reencode) = samples.upload(file)
-                sample_ids.append(sample_id)
-                session[f"uploaded_sample_id_{sample_id}"] = sample_id
-                session[f"filename_{sample_id}"] = original_filename
-                session[f"thumbnail_{sample_id}"] = f"{timestamp}.png"
-                session[f"stored_as_{sample_id}"] = stored_as
-                session[f"force_reencode"] = force_reencode
-
-            except Exception as ex:
-                return jsonify({"error": str(ex)}), 400
-
-        return jsonify({"sample_id": sample_ids[0]})
+        results = samples.upload_batch(files)
+        for result in results:
+            if "error" in result:
+                continue
+            sample_id = result["sample_id"]
+            sample_ids.append(sample_id)
+            session[f"uploaded_sample_id_{sample_id}"] = sample_id
+            session[f"filename_{sample_id}"] = result["filename"]
+            session[f"thumbnail_{sample_id}"] = result["thumbnail_filename"]
+            session[f"stored_as_{sample_id}"] = result["stored_as"]
+            session[f"force_reencode"] = result["force_reencode"]
+
+        file_results = [
+            {"filename": result["filename"], "sample_id": result["sample_id"], "jobs": result["jobs"]}
+            if "error" not in result else result
+            for result in results
+        ]
+        if not sample_ids:
+            return jsonify({"error": results[0]["error"], "files": file_results}), 400
+
+        # each file gets its own result, a failed file doesn't take the rest of the batch down with it
+        return jsonify({
+            "sample_id": sample_ids[0],
+            "jobs": [job_id for result in results for job_id in result.get("jobs", [])],
+            "files": file_results,
+        })
 
     return render_template("upload.html", title="Upload - YTPMV Sample Database", require_user_approval=REQUIRE_USER_APPROVAL)
 
 @main_bp.route("/login/", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
-        login_name = request.form["login"].lower()
-        password = request.form["password"]
-
-        user = User.query.filter(func.lower(User.email) == login_name).first()
-        if user and user.check_password(password):
-            login_user(user)
-            return redirect(url_for("main.home_page"))
-
-        user = User.query.filter(func.lower(User.username) == login_name).first()
-        if user and user.check_password(password):
+        user = auth.authenticate(request.form["login"], request.form["password"])
+        if user:
             login_user(user)
             return redirect(url_for("main.home_page"))
         flash("Login or password incorrect.", "error")
@@ -0,0 +1,183 @@
+import os
+import pickle
+import secrets
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_BACKEND, CACHE_DIR, CACHE_TTL
+
+# max entries kept by the in-process backend
+MEMORY_CACHE_SIZE = 1024
+# seconds between sweeps of the file backend's directory, per process
+FILE_SWEEP_INTERVAL = 600
+
+_missing = object()
+
+
+class MemoryCache:
+    """LRU cache local to one process, each gunicorn worker keeps (and invalidates) its own copy."""
+
+    def __init__(self, size=MEMORY_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def generation(self, namespace):
+        with self.lock:
+            return self.generations.setdefault(namespace, 0)
+
+    def bump(self, namespace):
+        with self.lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+            for key in [key for key in self.entries if key.startswith(f"{namespace}.")]:
+                del self.entries[key]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return _missing
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class FileCache:
+    """Cache kept in a directory, so every worker on the host sees the same entries and invalidations."""
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.last_sweep = time.monotonic()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _write(self, path, data):
+        # write then rename so readers never see half a file
+        fd, temp = tempfile.mkstemp(dir=self.directory, prefix=".tmp_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    def generation(self, namespace):
+        try:
+            with open(self._path(f"{namespace}.generation"), "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return "0"
+
+    def bump(self, namespace):
+        # the old generation's entries can't be reached anymore, sweep() removes them once they expire
+        self._write(self._path(f"{namespace}.generation"), secrets.token_hex(8).encode())
+
+    def sweep(self):
+        """Removes expired entries, which includes every entry of an old generation within a ttl of the bump."""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            try:
+                if name.startswith(".tmp_"):
+                    # left behind by a process that died mid-write
+                    if os.path.getmtime(path) < now - FILE_SWEEP_INTERVAL:
+                        os.remove(path)
+                    continue
+                if name.endswith(".generation"):
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        expires, _ = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    expires = 0
+                if expires < now:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                expires, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return _missing
+        if expires < time.time():
+            return _missing
+        return value
+
+    def set(self, key, value, ttl):
+        self._write(self._path(key), pickle.dumps((time.time() + ttl, value)))
+        with self.lock:
+            due = time.monotonic() - self.last_sweep > FILE_SWEEP_INTERVAL
+            if due:
+                self.last_sweep = time.monotonic()
+        if due:
+            self.sweep()
+
+
+def _make_backend():
+    match CACHE_BACKEND:
+        case "file":
+            return FileCache()
+        case _:
+            return MemoryCache()
+
+
+backend = _make_backend()
+# counted per group, so lookups made on every request (like the user loader's) don't drown out the pages
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count(group, stat):
+    with _stats_lock:
+        counts = _stats.setdefault(group, {"hits": 0, "misses": 0, "invalidations": 0})
+        counts[stat] += 1
+
+
+def cached(namespace, key, compute, ttl=CACHE_TTL, group="pages"):
+    """Returns the cached value for key, computing and storing it on a miss.
+
+    Entries are stored under the namespace's current generation, so invalidate() drops
+    every entry in the namespace at once, even ones a slow request is still computing.
+    """
+    full_key = f"{namespace}.{backend.generation(namespace)}.{key}"
+    value = backend.get(full_key)
+    if value is not _missing:
+        _count(group, "hits")
+        return value
+    _count(group, "misses")
+    value = compute()
+    backend.set(full_key, value, ttl)
+    return value
+
+
+def invalidate(namespace, group="pages"):
+    backend.bump(namespace)
+    _count(group, "invalidations")
+
+
+def _ratio(counts):
+    lookups = counts["hits"] + counts["misses"]
+    return {**counts, "hit_ratio": counts["hits"] / lookups if lookups else 0.0}
+
+
+def stats():
+    """Hit, miss and invalidation counts for this process, the pages at the top level and other groups under their name."""
+    empty = {"hits": 0, "misses": 0, "invalidations": 0}
+    with _stats_lock:
+        groups = {group: dict(counts) for group, counts in _stats.items()}
+    result = _ratio(groups.pop("pages", empty))
+    for group, counts in groups.items():
+        result[group] = _ratio(counts)
+    result["backend"] = CACHE_BACKEND
+    return result
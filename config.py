@@ -1,3 +1,4 @@
+import os
 import tomllib
 
 with open("config.toml", "rb") as f:
@@ -6,13 +7,72 @@ with open("config.toml", "rb") as f:
 REQUIRE_USER_APPROVAL = settings["require_user_approval"]
 VERSION = settings["version"]
 SECRET_KEY = settings["flask_secret_key"]
-SQLALCHEMY_DATABASE_URI = settings["database_url"]
+# the environment variable wins, so the benchmarks (see bench/) can point the app at a throwaway database
+SQLALCHEMY_DATABASE_URI = os.environ.get("YTPMVSD_DATABASE_URL") or settings["database_url"]
+# optional read replica, see replica.py
+DATABASE_REPLICA_URL = settings.get("database_replica_url", "")
+REPLICA_STICKY_SECONDS = settings.get("replica_sticky_seconds", 10)
 MB_UPLOAD_LIMIT = settings["mb_upload_limit"]
-MAX_CONTENT_LENGTH = MB_UPLOAD_LIMIT * 10 * 1000 * 1000
+MAX_FILES_PER_UPLOAD = 10
+# whole-request cap for a batch of files, each file is held to MB_UPLOAD_LIMIT while it streams in (see ingest.py)
+MAX_CONTENT_LENGTH = MB_UPLOAD_LIMIT * MAX_FILES_PER_UPLOAD * 1000 * 1000
 SAMPLES_PER_PAGE = settings["samples_per_page"]
 ALLOWED_UPLOAD_EXTENSIONS = settings["allowed_upload_extensions"]
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# connection pool of each worker process
+DB_POOL_SIZE = settings.get("db_pool_size", 5)
+DB_MAX_OVERFLOW = settings.get("db_max_overflow", 10)
+DB_POOL_TIMEOUT = settings.get("db_pool_timeout", 30)
+DB_POOL_RECYCLE = settings.get("db_pool_recycle", 1800)
+DB_POOL_PRE_PING = settings.get("db_pool_pre_ping", True)
+DB_STATEMENT_TIMEOUT = settings.get("db_statement_timeout", 0)
+
+
+def _engine_options(url):
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    # sqlite's pools don't take the sizing options and it has no statement timeout
+    if url.startswith("postgresql"):
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+        if DB_STATEMENT_TIMEOUT:
+            options["connect_args"] = {"options": f"-c statement_timeout={int(DB_STATEMENT_TIMEOUT * 1000)}"}
+    return options
+
+
+SQLALCHEMY_ENGINE_OPTIONS = _engine_options(SQLALCHEMY_DATABASE_URI)
+SQLALCHEMY_BINDS = {}
+if DATABASE_REPLICA_URL:
+    SQLALCHEMY_BINDS["replica"] = {"url": DATABASE_REPLICA_URL, **_engine_options(DATABASE_REPLICA_URL)}
+
+MEDIA_OFFLOAD = settings.get("media_offload", "")
+MEDIA_ACCEL_PREFIX = settings.get("media_accel_prefix", "/_media/")
+
+# web worker processes on this host, gunicorn's WEB_CONCURRENCY if it's set
+WEB_WORKERS = settings.get("web_workers") or int(os.environ.get("WEB_CONCURRENCY", 1))
+# "auto" shares the cores of the host between the web workers' job pools
+JOB_WORKERS = settings.get("job_workers", "auto")
+if JOB_WORKERS == "auto":
+    JOB_WORKERS = max(1, (os.cpu_count() or 2) // WEB_WORKERS)
+JOB_MAX_ATTEMPTS = settings.get("job_max_attempts", 3)
+
+REENCODE_CONCURRENCY = settings.get("reencode_concurrency", 1)
+REENCODE_THREADS = settings.get("reencode_threads", 2)
+REENCODE_NICE = settings.get("reencode_nice", 10)
+REENCODE_TIMEOUT = settings.get("reencode_timeout", 600)
+
+CACHE_BACKEND = settings.get("cache_backend", "memory")
+CACHE_DIR = settings.get("cache_dir", "cache")
+CACHE_TTL = settings.get("cache_ttl", 300)
+
+METRICS_DIR = settings.get("metrics_dir", "")
+SQL_PROFILER = settings.get("sql_profiler", False)
+
+BCRYPT_LOG_ROUNDS = settings.get("bcrypt_log_rounds", 12)
+# off by default with the memory backend, where an account change is only seen by the worker that made it
+USER_CACHE_TTL = settings.get("user_cache_ttl", 60 if CACHE_BACKEND == "file" else 0)
+
+COUNTER_RECONCILE_INTERVAL = settings.get("counter_reconcile_interval", 3600)
+
 USE_EMAIL_VERIFICATION = settings.get("use_email_verification", False)
 MAIL_SERVER = settings["mail_server"]
 MAIL_PORT = int(settings["mail_port"])
@@ -0,0 +1,153 @@
+from sqlalchemy import func
+
+from config import COUNTER_RECONCILE_INTERVAL
+from jobs import enqueue, job_handler
+from models import CatalogCounter, Job, Sample, db, tags_table
+from utils import dialect_insert
+
+# what a counter counts public samples of, ref_id is the source, user or tag id (0 for the overall total)
+SCOPES = ("public", "source", "uploader", "tag")
+# counters written per statement when filling the table, well under sqlite's bound parameter limit
+INSERT_BATCH_SIZE = 1000
+
+
+def snapshot(sample, tag_ids=None):
+    """The counters a sample currently adds one to, as {(scope, ref_id): 1}. Take it before changing the sample.
+
+    tag_ids overrides sample.tags, for when the tags were written without going through the relationship.
+    """
+    if sample is None or not sample.is_public:
+        return {}
+    keys = [("public", 0), ("uploader", sample.uploader)]
+    if sample.source_id is not None:
+        keys.append(("source", int(sample.source_id)))
+    if tag_ids is None:
+        tag_ids = [tag.id for tag in sample.tags]
+    keys.extend(("tag", tag_id) for tag_id in tag_ids)
+    return {key: 1 for key in keys}
+
+
+def update(before, sample, tag_ids=None):
+    """Adjusts the counters from a snapshot() taken before a change to the sample's state now (None once deleted).
+
+    Only the counters that actually changed are written, and nothing is committed,
+    so the adjustment lands in the same transaction as the change itself.
+    """
+    update_many([(before, snapshot(sample, tag_ids))])
+
+
+def update_many(changes):
+    """update() for a batch of samples at once, given (before, after) snapshot pairs. Writes one statement."""
+    deltas = {}
+    for before, after in changes:
+        for key in before.keys() | after.keys():
+            deltas[key] = deltas.get(key, 0) + after.get(key, 0) - before.get(key, 0)
+    _increment({key: delta for key, delta in deltas.items() if delta})
+
+
+def _increment(deltas):
+    if not deltas:
+        return
+    # sorted so concurrent transactions lock the rows in the same order
+    rows = [{"scope": scope, "ref_id": ref_id, "value": delta} for (scope, ref_id), delta in sorted(deltas.items())]
+    insert = dialect_insert()
+    if insert is not None:
+        stmt = insert(CatalogCounter).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["scope", "ref_id"],
+            set_={"value": CatalogCounter.value + stmt.excluded.value},
+        )
+        db.session.execute(stmt)
+        return
+    for row in rows:
+        result = db.session.execute(
+            db.update(CatalogCounter)
+            .where(CatalogCounter.scope == row["scope"], CatalogCounter.ref_id == row["ref_id"])
+            .values(value=CatalogCounter.value + row["value"])
+        )
+        if result.rowcount == 0:
+            db.session.execute(db.insert(CatalogCounter).values(row))
+
+
+def get(scope, ref_id=0):
+    value = db.session.query(CatalogCounter.value).filter_by(scope=scope, ref_id=ref_id).scalar()
+    return value or 0
+
+
+def get_all(scope):
+    """{ref_id: count} for every counter in a scope."""
+    return dict(db.session.query(CatalogCounter.ref_id, CatalogCounter.value).filter_by(scope=scope).all())
+
+
+def _actual():
+    public = Sample.is_public == True
+    actual = {("public", 0): db.session.query(func.count(Sample.id)).filter(public).scalar()}
+    for scope, column in (("source", Sample.source_id), ("uploader", Sample.uploader)):
+        rows = db.session.query(column, func.count(Sample.id)).filter(public, column.isnot(None)).group_by(column).all()
+        actual.update({(scope, ref_id): count for ref_id, count in rows})
+    rows = (
+        db.session.query(tags_table.c.tag_id, func.count(tags_table.c.sample_id))
+        .join(Sample, Sample.id == tags_table.c.sample_id)
+        .filter(public)
+        .group_by(tags_table.c.tag_id)
+        .all()
+    )
+    actual.update({("tag", ref_id): count for ref_id, count in rows})
+    return actual
+
+
+def reconcile():
+    """Recounts everything and fixes the counters that drifted, returns how many were off.
+
+    A change committed while this runs can be overwritten, the next reconcile puts it right.
+    """
+    actual = _actual()
+    stored = {(counter.scope, counter.ref_id): counter for counter in CatalogCounter.query.all()}
+    drifted = 0
+    missing = []
+    for key in actual.keys() | stored.keys():
+        value = actual.get(key, 0)
+        counter = stored.get(key)
+        if counter is None:
+            missing.append({"scope": key[0], "ref_id": key[1], "value": value})
+        elif counter.value != value:
+            counter.value = value
+            drifted += 1
+    if missing:
+        drifted += len(missing)
+        insert = dialect_insert()
+        if insert is not None:
+            # every worker reconciles an empty table at once on first start, whoever is second just writes the same counts
+            for start in range(0, len(missing), INSERT_BATCH_SIZE):
+                stmt = insert(CatalogCounter).values(missing[start:start + INSERT_BATCH_SIZE])
+                db.session.execute(stmt.on_conflict_do_update(index_elements=["scope", "ref_id"], set_={"value": stmt.excluded.value}))
+        else:
+            db.session.add_all(CatalogCounter(**row) for row in missing)
+    db.session.commit()
+    return drifted
+
+
+def _reconcile_queued():
+    return Job.query.filter(Job.kind == "reconcile_counters", Job.status == "queued").count()
+
+
+@job_handler("reconcile_counters")
+def reconcile_job(_):
+    # schedule the next run first, so a failing reconcile doesn't end the cycle. workers starting together
+    # can each queue a chain, one that finds another already queued ends so only one is left
+    if not _reconcile_queued():
+        enqueue("reconcile_counters", delay=COUNTER_RECONCILE_INTERVAL)
+    drifted = reconcile()
+    if drifted:
+        print(f"Reconciled {drifted} drifted catalog counter(s).")
+
+
+def init_app(app):
+    """Fills the counters on first run and makes sure a periodic reconcile is queued."""
+    with app.app_context():
+        if db.session.get(CatalogCounter, ("public", 0)) is None:
+            reconcile()
+        if COUNTER_RECONCILE_INTERVAL > 0 and not Job.query.filter(
+            Job.kind == "reconcile_counters", Job.status.in_(["queued", "running"])
+        ).count():
+            enqueue("reconcile_counters", delay=COUNTER_RECONCILE_INTERVAL)
@@ -0,0 +1,184 @@
+import fcntl
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import ffmpeg
+from sqlalchemy import update
+
+from config import REENCODE_CONCURRENCY, REENCODE_NICE, REENCODE_THREADS, REENCODE_TIMEOUT
+import metrics
+from jobs import RetryLater
+from models import Job, db
+from utils import probe_video
+
+SAMPLE_DIR = "static/media/samps"
+# x264 presets from best compression to fastest, longer clips and longer queues move down the list
+PRESETS = ["medium", "fast", "faster", "veryfast", "superfast", "ultrafast"]
+# seconds a reencode waits before trying again when every slot is taken
+SLOT_RETRY_DELAY = 15
+# how often the progress of a running reencode is written to its job
+PROGRESS_INTERVAL = 2
+
+
+def choose_preset(duration, queued):
+    """Picks a slower, smaller preset for short clips and a faster one for long clips or a long queue."""
+    step = 0
+    if duration and duration > 30:
+        step += 1
+    if duration and duration > 120:
+        step += 2
+    step += queued // max(1, 2 * REENCODE_CONCURRENCY)
+    return PRESETS[min(step, len(PRESETS) - 1)]
+
+
+def can_remux(probe):
+    """True if the streams can go into the output mp4 as they are: h264 in 4:2:0, aac or no audio, square pixels."""
+    video = probe.video_stream
+    audio = probe.audio_stream
+    if video is None or video.get("codec_name") != "h264" or video.get("pix_fmt") not in ("yuv420p", "yuvj420p"):
+        return False
+    if audio is not None and audio.get("codec_name") != "aac":
+        return False
+    return video.get("sample_aspect_ratio") in (None, "0:1", "1:1")
+
+
+class Slot:
+    """One of REENCODE_CONCURRENCY host-wide reencode slots, held with a file lock.
+
+    Every web worker and `flask run-jobs` process on the host shares the same lock files,
+    and a lock goes away with its process, so a crashed worker can't leak a slot.
+    """
+
+    def __init__(self):
+        self.file = None
+
+    def acquire(self):
+        for i in range(REENCODE_CONCURRENCY):
+            f = open(os.path.join(tempfile.gettempdir(), f"ytpmvsd-reencode-{i}.lock"), "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            self.file = f
+            return True
+        return False
+
+    def release(self):
+        if self.file is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+def _queued_reencodes():
+    return Job.query.filter(Job.kind == "reencode", Job.status == "queued").count()
+
+
+def _set_progress(sample_id, progress):
+    db.session.execute(
+        update(Job)
+        .where(Job.sample_id == sample_id, Job.kind == "reencode", Job.status == "running")
+        .values(progress=progress)
+    )
+    db.session.commit()
+
+
+def remove_stale_temp_files(directory=SAMPLE_DIR):
+    """Removes temp_* files left behind by reencodes that were killed before they could clean up."""
+    cutoff = time.time() - 2 * REENCODE_TIMEOUT
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith("temp_") and os.path.getmtime(path) < cutoff:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _run(args, duration, sample_id):
+    # ffmpeg writes key=value progress blocks to stdout, stderr goes to a file so it can't fill a pipe and stall
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr, text=True)
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        timer = threading.Timer(REENCODE_TIMEOUT, kill)
+        timer.start()
+        last_update = 0
+        try:
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                if key == "out_time_us" and duration and value.isdigit() and time.monotonic() - last_update > PROGRESS_INTERVAL:
+                    last_update = time.monotonic()
+                    _set_progress(sample_id, min(int(value) / 1e6 / duration, 1.0))
+            process.wait()
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+        if timed_out.is_set():
+            raise Exception(f"Reencode timed out after {REENCODE_TIMEOUT} seconds")
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise Exception(f"ffmpeg failed: {stderr.read()[-2000:].decode(errors='replace')}")
+
+
+def reencode_video(filename, output, sample_id=None):
+    """Reencodes (or just remuxes, if the streams allow it) a stored sample to output.
+
+    Runs in one of the host's reencode slots with a capped thread count and a lower priority,
+    and raises RetryLater when every slot is busy. Progress goes to the sample's running reencode job.
+    Raises on failure or timeout, output is removed in that case.
+    """
+    remove_stale_temp_files()
+    path = os.path.join(SAMPLE_DIR, filename)
+    probe = probe_video(path)
+
+    slot = Slot()
+    if not slot.acquire():
+        raise RetryLater(SLOT_RETRY_DELAY)
+    try:
+        stream = ffmpeg.input(path)
+        operation = "remux" if can_remux(probe) else "reencode"
+        if operation == "remux":
+            stream = stream.output(output, format="mp4", c="copy", movflags="+faststart")
+        else:
+            video_stream = probe.video_stream
+            width = int(video_stream.get("width"))
+            height = int(video_stream.get("height"))
+
+            sar = video_stream.get("sample_aspect_ratio")
+            if not sar or sar == "0:1":
+                sar = f"{width}:{height}"
+
+            stream = stream.output(
+                output,
+                format="mp4",
+                vcodec="libx264",
+                acodec="aac",
+                strict="experimental",
+                preset=choose_preset(probe.duration, _queued_reencodes()),
+                threads=REENCODE_THREADS,
+                movflags="+faststart",
+                vf=f"scale={width}:{height},setsar={sar},setdar={width}/{height}",
+            )
+        args = stream.global_args("-progress", "pipe:1", "-nostats").compile(overwrite_output=True)
+        if REENCODE_NICE:
+            args = ["nice", "-n", str(REENCODE_NICE)] + args
+        with metrics.ffmpeg_timer(operation):
+            _run(args, probe.duration, sample_id)
+    except Exception:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    finally:
+        slot.release()
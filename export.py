@@ -0,0 +1,114 @@
+import datetime
+import json
+import zlib
+
+import api
+from models import Metadata, Sample, Source, User, db
+
+# rows fetched from the server-side cursor at a time, each batch also gets one query for its tags
+EXPORT_BATCH_SIZE = 1000
+
+
+def parse_since(value):
+    """An ISO 8601 timestamp, taken as UTC if it has no offset. Raises ValueError."""
+    since = datetime.datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.UTC)
+    return since
+
+
+def _iso(value):
+    # sqlite hands timestamps back without their offset, they're all stored in UTC
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.UTC)
+    return value.isoformat()
+
+
+def export_samples(since=None):
+    """Every public sample as a dict, oldest change first, with its tags, source, uploader and metadata.
+
+    Rows come off a server-side cursor EXPORT_BATCH_SIZE at a time, so memory stays flat however big
+    the catalog is. With since, only samples changed at or after it are included: pass the largest
+    updated_at of the previous dump to pick up from there. Deleted or unpublished samples aren't
+    reported, they just stop showing up in full dumps.
+    """
+    query = (
+        db.select(
+            Sample.id,
+            Sample.filename,
+            Sample.stored_as,
+            Sample.thumbnail_filename,
+            Sample.upload_date,
+            Sample.updated_at,
+            Sample.like_count,
+            Sample.content_hash,
+            Sample.uploader,
+            User.username,
+            Sample.source_id,
+            Source.name.label("source_name"),
+            Metadata.filesize,
+            Metadata.width,
+            Metadata.height,
+            Metadata.aspect_ratio,
+            Metadata.framerate,
+            Metadata.codec,
+        )
+        .join(User, User.id == Sample.uploader)
+        .outerjoin(Source, Source.id == Sample.source_id)
+        .outerjoin(Metadata, Metadata.sample_id == Sample.id)
+        .where(Sample.is_public == True)
+        .order_by(Sample.updated_at, Sample.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE, replica=True)
+    )
+    if since is not None:
+        query = query.where(Sample.updated_at >= since)
+
+    for rows in db.session.execute(query).partitions():
+        tag_names = api.get_tag_names([row.id for row in rows])
+        for row in rows:
+            yield {
+                "id": row.id,
+                "filename": row.filename,
+                "stored_as": row.stored_as,
+                "thumbnail_filename": row.thumbnail_filename,
+                "upload_date": _iso(row.upload_date),
+                "updated_at": _iso(row.updated_at),
+                "likes": row.like_count,
+                "content_hash": row.content_hash,
+                "uploader": row.username,
+                "uploader_id": row.uploader,
+                "source": row.source_id,
+                "source_name": row.source_name,
+                "tags": tag_names[row.id],
+                "metadata": None if row.filesize is None else {
+                    "filesize": row.filesize,
+                    "width": row.width,
+                    "height": row.height,
+                    "aspect_ratio": row.aspect_ratio,
+                    "framerate": row.framerate,
+                    "codec": row.codec,
+                },
+            }
+
+
+def ndjson_chunks(since=None):
+    """export_samples() as NDJSON, one bytes chunk per batch."""
+    lines = []
+    for sample in export_samples(since):
+        lines.append(json.dumps(sample, separators=(",", ":")))
+        if len(lines) == EXPORT_BATCH_SIZE:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 writes a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+
+from flask import Request
+
+from config import MB_UPLOAD_LIMIT
+
+UPLOAD_DIR = "static/media/samps"
+FILE_SIZE_LIMIT = MB_UPLOAD_LIMIT * 1000 * 1000
+# enough of the file to read the ftyp box of an mp4
+SNIFF_BYTES = 64
+# .upload_* files older than this belong to a worker that died mid-upload
+STALE_UPLOAD_AGE = 6 * 60 * 60
+# how often a process looks for them
+STALE_SWEEP_INTERVAL = 60 * 60
+
+# ISO base media brands that mean the upload has to be reencoded before it's usable
+M4V_BRANDS = {b"M4V ", b"M4VH", b"M4VP"}
+MOV_BRANDS = {b"qt  "}
+
+ALLOWED_UPLOAD_EXTENSIONS = ["mp4"]
+ALLOWED_UPLOAD_EXTENSIONS_WITH_REENCODE = ["m4v"]
+
+TOO_LARGE_MESSAGE = f"This file exceeded the file limit. Max supported filesize is {MB_UPLOAD_LIMIT}MB per file."
+UNSUPPORTED_MESSAGE = "There is an error with this file. Please make sure it is a valid .mp4 file."
+
+
+def sniff_extension(head):
+    """Guesses the container from the first bytes of a file, returns None if it isn't an ISO base media file."""
+    if len(head) < 12 or head[4:8] != b"ftyp":
+        return None
+    brand = head[8:12]
+    if brand in M4V_BRANDS:
+        return "m4v"
+    if brand in MOV_BRANDS:
+        return "mov"
+    return "mp4"
+
+
+class IngestFile:
+    """A file object that werkzeug streams an uploaded file into.
+
+    The upload goes straight to a temp file next to its final location while it's hashed and sniffed,
+    and writing stops as soon as it gets too big or clearly isn't a video, so a bad upload
+    costs a few KB of I/O instead of the whole file. A rejected file sets error and swallows the rest
+    of its part, so the other files of the same request still go through.
+    """
+
+    def __init__(self, directory=UPLOAD_DIR, limit=FILE_SIZE_LIMIT):
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix=".upload_")
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self.limit = limit
+        self.size = 0
+        self.head = b""
+        self.committed = False
+        self.error = None
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    @property
+    def extension(self):
+        return sniff_extension(self.head)
+
+    def _reject(self, error):
+        self.error = error
+        self.close()
+
+    def write(self, data):
+        if self.error:
+            return len(data)
+        self.size += len(data)
+        if self.size > self.limit:
+            self._reject(TOO_LARGE_MESSAGE)
+            return len(data)
+
+        if len(self.head) < SNIFF_BYTES:
+            self.head += bytes(data[:SNIFF_BYTES - len(self.head)])
+            if len(self.head) >= 12:
+                extension = self.extension
+                if extension not in ALLOWED_UPLOAD_EXTENSIONS + ALLOWED_UPLOAD_EXTENSIONS_WITH_REENCODE:
+                    self._reject(UNSUPPORTED_MESSAGE)
+                    return len(data)
+
+        self._hash.update(data)
+        return self._file.write(data)
+
+    # werkzeug rewinds every part once it's written, a rejected one has nothing left to read
+    def read(self, *args):
+        return b"" if self.error else self._file.read(*args)
+
+    def seek(self, *args):
+        return 0 if self.error else self._file.seek(*args)
+
+    def tell(self):
+        return 0 if self.error else self._file.tell()
+
+    def flush(self):
+        return self._file.flush()
+
+    def commit(self, path):
+        """Atomically moves the finished upload to path."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.chmod(self.path, 0o644)
+        os.replace(self.path, path)
+        self.committed = True
+
+    def close(self):
+        # anything that wasn't committed is thrown away, werkzeug closes every file at the end of the request
+        if not self._file.closed:
+            self._file.close()
+        if not self.committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+
+def ingest(file):
+    """Returns the IngestFile behind a FileStorage, spooling it into one first if it came from somewhere else."""
+    if isinstance(file.stream, IngestFile):
+        return file.stream
+    ingested = IngestFile()
+    try:
+        shutil.copyfileobj(file.stream, ingested)
+    except Exception:
+        ingested.close()
+        raise
+    return ingested
+
+
+_last_sweep = None
+
+
+def remove_stale_uploads(directory=UPLOAD_DIR):
+    """Removes .upload_* files left behind by workers that were killed in the middle of an upload."""
+    cutoff = time.time() - STALE_UPLOAD_AGE
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if name.startswith(".upload_") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        global _last_sweep
+        ingested = IngestFile()
+        if _last_sweep is None or time.monotonic() - _last_sweep > STALE_SWEEP_INTERVAL:
+            _last_sweep = time.monotonic()
+            remove_stale_uploads()
+        # kept here as well as in request.files, a part that fails halfway through parsing never makes it there
+        self.__dict__.setdefault("_ingested", []).append(ingested)
+        return ingested
+
+    def close(self):
+        super().close()
+        for ingested in self.__dict__.get("_ingested", ()):
+            ingested.close()
@@ -0,0 +1,248 @@
+import datetime
+import threading
+import time
+
+from sqlalchemy import exists, update
+from sqlalchemy.orm import aliased
+
+from config import JOB_WORKERS, JOB_MAX_ATTEMPTS
+from models import Job, db
+
+# seconds an idle worker sleeps before looking for new jobs again
+POLL_INTERVAL = 1
+# a job still "running" after this long belongs to a worker that died, so it gets handed out again
+STALE_AFTER = datetime.timedelta(minutes=30)
+# seconds between looks for such jobs, once per process rather than on every poll of every worker
+REQUEUE_INTERVAL = 60
+
+_handlers = {}
+_failure_handlers = {}
+_started = False
+_start_lock = threading.Lock()
+_wakeup = threading.Event()
+_requeue_lock = threading.Lock()
+_last_requeue = None
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying can't help, e.g. the uploaded file isn't a video."""
+
+
+class RetryLater(Exception):
+    """Raised by a job handler that can't run right now, e.g. every reencode slot is taken.
+
+    The job goes back in the queue for delay seconds without using up one of its attempts.
+    """
+
+    def __init__(self, delay):
+        super().__init__(f"Retrying in {delay} seconds")
+        self.delay = delay
+
+
+def job_handler(kind, on_failure=None):
+    """Registers a function as the handler for jobs of the given kind.
+
+    The handler is called with the job's sample_id inside an app context. on_failure, if given,
+    is called with the sample_id once the job has failed for good.
+    """
+    def decorator(func):
+        _handlers[kind] = func
+        if on_failure is not None:
+            _failure_handlers[kind] = on_failure
+        return func
+    return decorator
+
+
+def _now():
+    return datetime.datetime.now(datetime.UTC)
+
+
+def enqueue(kind, sample_id=None, max_attempts=JOB_MAX_ATTEMPTS, commit=True, delay=0):
+    """Queues a job and returns its id. Jobs for the same sample always run one at a time, in the order they were queued.
+
+    With a delay (in seconds) the job isn't run before that much time has passed.
+    """
+    return enqueue_many(kind, [sample_id], max_attempts, commit, delay)[0]
+
+
+def enqueue_many(kind, sample_ids, max_attempts=JOB_MAX_ATTEMPTS, commit=True, delay=0):
+    """enqueue() for several samples at once, in a single insert. Returns the job ids in the same order."""
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    now = _now()
+    jobs = [
+        Job(
+            kind=kind,
+            sample_id=sample_id,
+            status="queued",
+            attempts=0,
+            max_attempts=max_attempts,
+            run_after=now + datetime.timedelta(seconds=delay),
+            created_at=now,
+            updated_at=now,
+        )
+        for sample_id in sample_ids
+    ]
+    db.session.add_all(jobs)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    _wakeup.set()
+    return [job.id for job in jobs]
+
+
+def get_job(job_id):
+    return Job.query.get(job_id)
+
+
+def job_jsonify(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "sample_id": job.sample_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "error": job.error,
+        "progress": job.progress,
+        "created_at": job.created_at,
+        "updated_at": job.updated_at,
+    }
+
+
+def cancel_sample_jobs(sample_id):
+    """Cancels everything still queued for a sample, used when its upload turns out to be unusable."""
+    db.session.execute(
+        update(Job)
+        .where(Job.sample_id == sample_id, Job.status == "queued")
+        .values(status="cancelled", updated_at=_now())
+    )
+    db.session.commit()
+
+
+def requeue_stale():
+    """Puts jobs whose worker went away mid-run back in the queue, at most once every REQUEUE_INTERVAL in this process."""
+    global _last_requeue
+    with _requeue_lock:
+        if _last_requeue is not None and time.monotonic() - _last_requeue < REQUEUE_INTERVAL:
+            return
+        _last_requeue = time.monotonic()
+    now = _now()
+    db.session.execute(
+        update(Job)
+        .where(Job.status == "running", Job.updated_at < now - STALE_AFTER)
+        .values(status="queued", updated_at=now)
+    )
+    db.session.commit()
+
+
+def _claim():
+    now = _now()
+    earlier = aliased(Job)
+    candidates = (
+        db.session.query(Job.id)
+        .filter(Job.status == "queued", Job.run_after <= now)
+        .filter(~exists().where(
+            earlier.sample_id == Job.sample_id,
+            earlier.id < Job.id,
+            earlier.status.in_(["queued", "running"]),
+        ))
+        .order_by(Job.id)
+        .limit(5)
+        .all()
+    )
+
+    # the conditional UPDATE is what actually hands out the job, so several workers
+    # (or several gunicorn processes) can race on the same candidate safely.
+    for (job_id,) in candidates:
+        result = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "queued")
+            .values(status="running", attempts=Job.attempts + 1, updated_at=now)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def _finish(job, error=None, permanent=False):
+    job.updated_at = _now()
+    if error is None:
+        job.status = "done"
+        job.error = None
+    elif permanent or job.attempts >= job.max_attempts:
+        job.status = "failed"
+        job.error = error
+    else:
+        # back off a little more after each failed attempt
+        job.status = "queued"
+        job.error = error
+        job.run_after = job.updated_at + datetime.timedelta(seconds=10 * 2 ** (job.attempts - 1))
+    db.session.commit()
+
+
+def run_one():
+    """Claims and runs a single job, returns False when there was nothing to do."""
+    job = _claim()
+    if job is None:
+        return False
+
+    try:
+        _handlers[job.kind](job.sample_id)
+        _finish(job)
+    except RetryLater as e:
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        job.status = "queued"
+        job.attempts -= 1
+        job.updated_at = _now()
+        job.run_after = job.updated_at + datetime.timedelta(seconds=e.delay)
+        db.session.commit()
+    except Exception as e:
+        print(f"Job {job.id} ({job.kind}) failed: {e}")
+        db.session.rollback()
+        job = db.session.get(Job, job.id)
+        permanent = isinstance(e, PermanentJobError)
+        # the failure handler runs while the job still counts as running,
+        # so the sample's later jobs can't be picked up before it has cleaned up after it
+        if (permanent or job.attempts >= job.max_attempts) and job.kind in _failure_handlers:
+            try:
+                _failure_handlers[job.kind](job.sample_id)
+            except Exception as ex:
+                db.session.rollback()
+                print(f"Failure handler for job {job.id} ({job.kind}) failed: {ex}")
+            job = db.session.get(Job, job.id)
+        _finish(job, str(e), permanent=permanent)
+    return True
+
+
+def work(app, stop=None):
+    """Worker loop, runs jobs until stop is set."""
+    while stop is None or not stop.is_set():
+        with app.app_context():
+            try:
+                requeue_stale()
+                ran = run_one()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Job worker error: {e}")
+                ran = False
+        if not ran:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def start_workers(app, count=JOB_WORKERS):
+    """Starts the in-process worker pool once per process. With job_workers = 0 jobs only run through `flask run-jobs`."""
+    global _started
+    if _started or count <= 0:
+        return
+    with _start_lock:
+        if _started:
+            return
+        for i in range(count):
+            threading.Thread(target=work, args=(app,), name=f"job-worker-{i}", daemon=True).start()
+        _started = True
+
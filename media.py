@@ -0,0 +1,97 @@
+import os
+import unicodedata
+from urllib.parse import quote
+
+from flask import Response, request, send_file
+
+from config import MEDIA_OFFLOAD, MEDIA_ACCEL_PREFIX
+
+MEDIA_ROOT = "static/media"
+# thumbnails are named by their content, so browsers can keep them for a year.
+# samples are served under their id, which can be edited, made private or deleted,
+# so those are revalidated against their ETag every time instead
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def media_etag(path, content_hash=None):
+    """Strong ETag for a stored file, its content hash if known, otherwise its mtime and size."""
+    if content_hash:
+        return content_hash
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def _filename_options(download_name):
+    # same as send_file, non-ascii names go in filename* with an ascii fallback
+    try:
+        download_name.encode("ascii")
+        return {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"}
+
+
+def send_media(relative_path, download_name=None, as_attachment=False, content_hash=None, public=True):
+    """Sends a file under static/media, after the caller has done its permission checks.
+
+    With media_offload set the web server sends the bytes (and handles Range requests) through
+    X-Accel-Redirect or X-Sendfile, so the worker is done as soon as the headers are built.
+    Otherwise werkzeug serves it with Range, If-Range and ETag support.
+    Responses are no-cache with an ETag, so caches revalidate and get a 304 while the file is unchanged.
+    Private samples get private cache headers so shared caches don't keep them.
+    """
+    path = os.path.join(MEDIA_ROOT, relative_path)
+    if not os.path.exists(path):
+        return Response(status=404)
+    etag = media_etag(path, content_hash)
+
+    if not MEDIA_OFFLOAD:
+        response = send_file(
+            path,
+            mimetype="video/mp4",
+            as_attachment=as_attachment,
+            download_name=download_name,
+            etag=etag,
+            conditional=True,
+        )
+        return _revalidate(response, public)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(mimetype="video/mp4")
+        if MEDIA_OFFLOAD == "x-accel":
+            response.headers["X-Accel-Redirect"] = MEDIA_ACCEL_PREFIX.rstrip("/") + "/" + relative_path
+        else:
+            response.headers["X-Sendfile"] = os.path.abspath(path)
+        if download_name:
+            response.headers.set("Content-Disposition", "attachment" if as_attachment else "inline", **_filename_options(download_name))
+    response.set_etag(etag)
+    return _revalidate(response, public)
+
+
+def _revalidate(response, public):
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    response.cache_control.max_age = None
+    response.cache_control.no_cache = True
+    return response
+
+
+def init_app(app):
+    @app.after_request
+    def cache_media(response):
+        # thumbnails go through the regular static route, their content-hashed names make them safe to keep for good.
+        # not a 404 though, the thumbnail may just not have been made yet
+        if (
+            response.status_code == 200
+            and request.endpoint == "static"
+            and request.view_args.get("filename", "").startswith("media/thumbs/")
+        ):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
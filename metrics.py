@@ -0,0 +1,297 @@
+import atexit
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from config import METRICS_DIR
+from models import Job, db
+
+PREFIX = "ytpmvsd_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+FFMPEG_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# seconds between writes of this process's numbers to METRICS_DIR
+FLUSH_INTERVAL = 1
+# where the numbers of processes that exited are added up
+RETIRED_FILE = "retired.json"
+
+# name: (type, help, buckets)
+METRICS = {
+    "request_duration_seconds": ("histogram", "Time spent handling a request.", LATENCY_BUCKETS),
+    "request_sql_queries": ("histogram", "SQL queries run while handling a request.", QUERY_COUNT_BUCKETS),
+    "request_sql_seconds": ("histogram", "Time spent in SQL while handling a request.", LATENCY_BUCKETS),
+    "sql_queries_total": ("counter", "SQL queries run, inside requests or not.", None),
+    "ffmpeg_runs_total": ("counter", "ffprobe/ffmpeg invocations.", None),
+    "ffmpeg_duration_seconds": ("histogram", "Time taken by ffprobe/ffmpeg invocations.", FFMPEG_BUCKETS),
+    "upload_bytes_total": ("counter", "Bytes received in uploaded files that were accepted, duplicates included.", None),
+    "uploads_total": ("counter", "Uploaded files, by outcome.", None),
+}
+
+_values = {}
+_lock = threading.Lock()
+# held while this process's file is written or retired, so a late flush can't bring it back
+_flush_lock = threading.Lock()
+_flusher = None
+_process = None
+_retired = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        key = _key(name, labels)
+        _values[key] = _values.get(key, 0) + value
+    _start_flusher()
+
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    with _lock:
+        key = _key(name, labels)
+        # one count per bucket, then the sum and the count
+        histogram = _values.setdefault(key, [0] * (len(buckets) + 2))
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+    _start_flusher()
+
+
+@contextmanager
+def ffmpeg_timer(operation):
+    """Counts and times one ffprobe/ffmpeg run, operation is e.g. "probe", "thumbnail" or "reencode"."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        observe("ffmpeg_duration_seconds", time.perf_counter() - start, operation=operation)
+        inc("ffmpeg_runs_total", operation=operation, outcome=outcome)
+
+
+def _snapshot():
+    with _lock:
+        return [[name, dict(labels), value] for (name, labels), value in _values.items()]
+
+
+def _process_file():
+    # pids get reused, by a restarted container or a new gunicorn worker, so the name gets a token of its own.
+    # a forked worker notices its pid changed and picks a new one
+    global _process
+    if _process is None or _process[0] != os.getpid():
+        _process = (os.getpid(), f"{os.getpid()}-{uuid.uuid4().hex}.json")
+    return os.path.join(METRICS_DIR, _process[1])
+
+
+@contextmanager
+def _dir_lock(mode):
+    with open(os.path.join(METRICS_DIR, ".lock"), "w") as f:
+        fcntl.flock(f, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _merge(merged, entries):
+    for metric, labels, value in entries:
+        key = _key(metric, labels)
+        if isinstance(value, list):
+            total = merged.setdefault(key, [0] * len(value))
+            merged[key] = [a + b for a, b in zip(total, value)]
+        else:
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _write(path, entries):
+    fd, temp = tempfile.mkstemp(dir=METRICS_DIR, prefix=".tmp_")
+    with os.fdopen(fd, "w") as f:
+        json.dump(entries, f)
+    os.replace(temp, path)
+
+
+def _flush():
+    # each process keeps its own file, a scrape adds them all up
+    with _flush_lock:
+        if _retired == os.getpid():
+            return
+        _write(_process_file(), _snapshot())
+
+
+def _retire():
+    # on a clean exit this process's numbers move into RETIRED_FILE, so the totals don't jump back
+    # when gunicorn replaces a worker and the directory doesn't fill up with files of dead processes.
+    # a worker that's killed outright leaves its file behind, it's still counted until METRICS_DIR is emptied
+    global _retired
+    with _flush_lock:
+        if _retired == os.getpid():
+            return
+        _retired = os.getpid()
+        entries = _snapshot()
+        try:
+            with _dir_lock(fcntl.LOCK_EX):
+                retired = _merge(_merge({}, _read(os.path.join(METRICS_DIR, RETIRED_FILE))), entries)
+                _write(os.path.join(METRICS_DIR, RETIRED_FILE), [[name, dict(labels), value] for (name, labels), value in retired.items()])
+                if os.path.exists(_process_file()):
+                    os.remove(_process_file())
+        except OSError as e:
+            print(f"Couldn't retire metrics: {e}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            _flush()
+        except OSError as e:
+            print(f"Couldn't write metrics: {e}")
+
+
+def _start_flusher():
+    global _flusher
+    if not METRICS_DIR or (_flusher is not None and _flusher.pid == os.getpid()):
+        return
+    with _lock:
+        if _flusher is not None and _flusher.pid == os.getpid():
+            return
+        # a forked worker needs a thread of its own, the parent's didn't come along
+        thread = threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True)
+        thread.pid = os.getpid()
+        thread.start()
+        _flusher = thread
+        atexit.register(_retire)
+
+
+def _collect():
+    if not METRICS_DIR:
+        return _snapshot()
+    _flush()
+    merged = {}
+    # shared with other scrapes, but not with a process moving its numbers into RETIRED_FILE
+    with _dir_lock(fcntl.LOCK_SH):
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith(".json"):
+                _merge(merged, _read(os.path.join(METRICS_DIR, name)))
+    return [[name, dict(labels), value] for (name, labels), value in merged.items()]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def render():
+    """Every metric in the Prometheus text format, added up over all the processes sharing METRICS_DIR."""
+    by_name = {}
+    for name, labels, value in _collect():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+        for labels, value in sorted(by_name.get(name, []), key=lambda entry: sorted(entry[0].items())):
+            if kind == "histogram":
+                for bound, count in zip(buckets, value):
+                    lines.append(f"{PREFIX}{name}_bucket{_labels(labels, le=bound)} {count}")
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels, le='+Inf')} {value[-1]}")
+                lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {value[-2]}")
+                lines.append(f"{PREFIX}{name}_count{_labels(labels)} {value[-1]}")
+            else:
+                lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+
+    # the queue is shared by every worker already, so it's read from the database at scrape time
+    lines.append(f"# HELP {PREFIX}jobs Background jobs waiting or running.")
+    lines.append(f"# TYPE {PREFIX}jobs gauge")
+    rows = (
+        db.session.query(Job.kind, Job.status, func.count(Job.id))
+        .filter(Job.status.in_(["queued", "running"]))
+        .group_by(Job.kind, Job.status)
+        .all()
+    )
+    for kind, status, count in rows:
+        lines.append(f"{PREFIX}jobs{_labels({'kind': kind, 'status': status})} {count}")
+    return "\n".join(lines) + "\n"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    inc("sql_queries_total")
+    if has_request_context():
+        g.sql_queries = g.get("sql_queries", 0) + 1
+        g.sql_seconds = g.get("sql_seconds", 0.0) + elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # a failed query never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def init_app(app):
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def remember_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request(_):
+        if "request_start" not in g or request.endpoint == "metrics":
+            return
+        labels = {
+            "blueprint": request.blueprint or "",
+            "endpoint": request.endpoint or "unmatched",
+            "method": request.method,
+            # an exception skips after_request, so no status means it ended in a 500
+            "status": g.get("response_status", 500),
+        }
+        observe("request_duration_seconds", time.perf_counter() - g.request_start, **labels)
+        observe("request_sql_queries", g.get("sql_queries", 0), **labels)
+        observe("request_sql_seconds", g.get("sql_seconds", 0.0), **labels)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
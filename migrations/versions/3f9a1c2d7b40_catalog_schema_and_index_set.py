@@ -0,0 +1,121 @@
+"""catalog schema and index set
+
+Brings a database made by an older db.create_all() up to the current models: the like_count,
+content_hash, perceptual_hash and streams columns, the job and catalog_counter tables, the
+job progress column, and the index set declared in models.py. Every step checks what's already
+there, so it's a no-op on a database create_all() just made.
+
+ix_tag_name is unique, duplicate tag names have to be merged before this runs. The pg_trgm
+index on source names comes in b7e2d94f1c68, since it needs the extension.
+
+Revision ID: 3f9a1c2d7b40
+Revises:
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2d7b40'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+PUBLIC = {"postgresql_where": sa.text("is_public = true"), "sqlite_where": sa.text("is_public = 1")}
+QUEUED = {"postgresql_where": sa.text("status = 'queued'"), "sqlite_where": sa.text("status = 'queued'")}
+
+# name: (table, columns, unique, partial index options)
+INDEXES = {
+    "ix_sample_public_latest": ("sample", ["upload_date", "id"], False, PUBLIC),
+    "ix_sample_public_liked": ("sample", ["like_count", "id"], False, PUBLIC),
+    "ix_sample_public_source": ("sample", ["source_id", "upload_date"], False, PUBLIC),
+    "ix_sample_uploader_date": ("sample", ["uploader", "upload_date"], False, {}),
+    "ix_sample_content_hash": ("sample", ["content_hash"], False, {}),
+    "ix_tags_sample_id": ("tags", ["sample_id"], False, {}),
+    "ix_likes_sample_id": ("likes", ["sample_id"], False, {}),
+    "ix_tag_name": ("tag", ["name"], True, {}),
+    "ix_user_email_lower": ("user", [sa.text("lower(email)")], False, {}),
+    "ix_user_username_lower": ("user", [sa.text("lower(username)")], False, {}),
+    "ix_job_sample_id": ("job", ["sample_id"], False, {}),
+    "ix_job_status": ("job", ["status"], False, {}),
+    "ix_job_queued_run_after": ("job", ["run_after"], False, QUEUED),
+}
+
+# the ones this revision introduced, the rest came with earlier models
+NEW_INDEXES = [
+    "ix_sample_public_latest",
+    "ix_sample_public_liked",
+    "ix_sample_public_source",
+    "ix_sample_uploader_date",
+    "ix_tags_sample_id",
+    "ix_likes_sample_id",
+    "ix_job_queued_run_after",
+]
+
+
+def _columns(inspector, table):
+    return {column["name"] for column in inspector.get_columns(table)}
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+
+    sample_columns = _columns(inspector, "sample")
+    with op.batch_alter_table("sample") as batch_op:
+        if "like_count" not in sample_columns:
+            batch_op.add_column(sa.Column("like_count", sa.Integer(), server_default="0", nullable=False))
+        if "content_hash" not in sample_columns:
+            batch_op.add_column(sa.Column("content_hash", sa.String(length=64), nullable=True))
+        if "perceptual_hash" not in sample_columns:
+            batch_op.add_column(sa.Column("perceptual_hash", sa.String(length=16), nullable=True))
+    if "like_count" not in sample_columns:
+        op.execute("UPDATE sample SET like_count = (SELECT count(*) FROM likes WHERE likes.sample_id = sample.id)")
+
+    if "streams" not in _columns(inspector, "metadata"):
+        with op.batch_alter_table("metadata") as batch_op:
+            batch_op.add_column(sa.Column("streams", sa.JSON(), nullable=True))
+
+    if "job" not in tables:
+        op.create_table(
+            "job",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("kind", sa.String(), nullable=False),
+            sa.Column("sample_id", sa.Integer(), nullable=True),
+            sa.Column("status", sa.String(length=16), nullable=False),
+            sa.Column("attempts", sa.Integer(), nullable=False),
+            sa.Column("max_attempts", sa.Integer(), nullable=False),
+            sa.Column("error", sa.String(), nullable=True),
+            sa.Column("progress", sa.Float(), nullable=True),
+            sa.Column("run_after", sa.TIMESTAMP(timezone=True), nullable=False),
+            sa.Column("created_at", sa.TIMESTAMP(timezone=True), nullable=False),
+            sa.Column("updated_at", sa.TIMESTAMP(timezone=True), nullable=False),
+            sa.PrimaryKeyConstraint("id"),
+        )
+    elif "progress" not in _columns(inspector, "job"):
+        with op.batch_alter_table("job") as batch_op:
+            batch_op.add_column(sa.Column("progress", sa.Float(), nullable=True))
+
+    # filled in by counters.init_app on the next start
+    if "catalog_counter" not in tables:
+        op.create_table(
+            "catalog_counter",
+            sa.Column("scope", sa.String(length=16), nullable=False),
+            sa.Column("ref_id", sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column("value", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("scope", "ref_id"),
+        )
+
+    # replaced by ix_sample_public_liked
+    op.drop_index("ix_sample_like_count", table_name="sample", if_exists=True)
+    for name, (table, columns, unique, options) in INDEXES.items():
+        op.create_index(name, table, columns, unique=unique, if_not_exists=True, **options)
+
+
+def downgrade():
+    # back to the indexes the models had before, the columns and tables stay since the code can't run without them
+    for name in NEW_INDEXES:
+        op.drop_index(name, table_name=INDEXES[name][0], if_exists=True)
+    op.create_index("ix_sample_like_count", "sample", ["like_count"], if_not_exists=True)
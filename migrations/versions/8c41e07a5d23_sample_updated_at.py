@@ -0,0 +1,38 @@
+"""sample updated_at
+
+Adds Sample.updated_at for incremental exports (see export.py), existing samples start out at
+their upload date. A no-op on a database create_all() just made.
+
+Revision ID: 8c41e07a5d23
+Revises: 3f9a1c2d7b40
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41e07a5d23'
+down_revision = '3f9a1c2d7b40'
+branch_labels = None
+depends_on = None
+
+PUBLIC = {"postgresql_where": sa.text("is_public = true"), "sqlite_where": sa.text("is_public = 1")}
+
+
+def upgrade():
+    columns = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("sample")}
+    if "updated_at" not in columns:
+        with op.batch_alter_table("sample") as batch_op:
+            batch_op.add_column(sa.Column("updated_at", sa.TIMESTAMP(timezone=True), nullable=True))
+        op.execute("UPDATE sample SET updated_at = upload_date")
+        with op.batch_alter_table("sample") as batch_op:
+            batch_op.alter_column("updated_at", existing_type=sa.TIMESTAMP(timezone=True), nullable=False)
+    op.create_index("ix_sample_public_updated", "sample", ["updated_at", "id"], if_not_exists=True, **PUBLIC)
+
+
+def downgrade():
+    op.drop_index("ix_sample_public_updated", table_name="sample", if_exists=True)
+    with op.batch_alter_table("sample") as batch_op:
+        batch_op.drop_column("updated_at")
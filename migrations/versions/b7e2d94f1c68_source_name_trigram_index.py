@@ -0,0 +1,41 @@
+"""source name trigram index
+
+Installs pg_trgm and the trigram index source_search uses for source lookups on Postgres. On
+other databases, or a Postgres where the extension can't be installed, this does nothing and
+source_search keeps using its in-memory index.
+
+Revision ID: b7e2d94f1c68
+Revises: 8c41e07a5d23
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d94f1c68'
+down_revision = '8c41e07a5d23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != "postgresql":
+        return
+    try:
+        # creating an extension needs rights the app's role may not have, that mustn't fail the whole upgrade
+        with bind.begin_nested():
+            op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except sa.exc.DBAPIError as e:
+        print(f"pg_trgm isn't available, source search will use its in-memory index: {e}")
+        return
+    op.execute("CREATE INDEX IF NOT EXISTS ix_source_name_trgm ON source USING gin (name gin_trgm_ops)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    # the extension is left installed, other things may use it
+    op.execute("DROP INDEX IF EXISTS ix_source_name_trgm")
@@ -1,11 +1,14 @@
 import datetime
+import os
 
 from flask_bcrypt import Bcrypt
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import TIMESTAMP
+from sqlalchemy import TIMESTAMP, func
 
-db = SQLAlchemy()
+from replica import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 bcrypt = Bcrypt()
 
@@ -39,12 +42,42 @@ class Sample(db.Model):
     uploader = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     source_id = db.Column(db.Integer, db.ForeignKey("source.id"), nullable=True)
     is_public = db.Column(db.Boolean, default=False, nullable=False)
+    # denormalized len(likes), kept in step by like_sample and fixed up by `flask recount-likes`
+    like_count = db.Column(db.Integer, default=0, server_default="0", nullable=False)
+    # sha256 of the stored file, samples with the same hash share one file on disk
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    # 64 bit dHash of the thumbnail in hex, filled in by `flask near-duplicates`
+    perceptual_hash = db.Column(db.String(16), nullable=True)
+    # set by every update of the row, set_sample_tags and update_metadata also touch it, for incremental exports
+    updated_at = db.Column(
+        TIMESTAMP(timezone=True),
+        nullable=False,
+        default=lambda: datetime.datetime.now(datetime.UTC),
+        onupdate=lambda: datetime.datetime.now(datetime.UTC),
+    )
 
     source = db.relationship("Source", back_populates="samples")
     likes = db.relationship("User", secondary=likes_table, backref="liked_samples")
     tags = db.relationship("Tag", secondary=tags_table, back_populates="samples")
     sample_metadata = db.relationship("Metadata", back_populates="sample")
 
+    @property
+    def small_thumbnail_filename(self):
+        return os.path.splitext(self.thumbnail_filename)[0] + "_small.webp"
+
+# the index set, the migrations put it on databases made before it.
+# listings only show public samples, so their sort orders are indexed over public rows alone
+_public = Sample.is_public == True
+db.Index("ix_sample_public_latest", Sample.upload_date, Sample.id, postgresql_where=_public, sqlite_where=_public)
+db.Index("ix_sample_public_liked", Sample.like_count, Sample.id, postgresql_where=_public, sqlite_where=_public)
+db.Index("ix_sample_public_source", Sample.source_id, Sample.upload_date, postgresql_where=_public, sqlite_where=_public)
+db.Index("ix_sample_public_updated", Sample.updated_at, Sample.id, postgresql_where=_public, sqlite_where=_public)
+# a user's page shows their private samples too
+db.Index("ix_sample_uploader_date", Sample.uploader, Sample.upload_date)
+# the primary keys of the link tables lead with the other column
+db.Index("ix_tags_sample_id", tags_table.c.sample_id)
+db.Index("ix_likes_sample_id", likes_table.c.sample_id)
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(80), unique=True)
@@ -65,6 +98,10 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return bcrypt.check_password_hash(self.password_hash, password)
 
+# logins match email or username case-insensitively
+db.Index("ix_user_email_lower", func.lower(User.email))
+db.Index("ix_user_username_lower", func.lower(User.username))
+
 class Metadata(db.Model):
     sample_id = db.Column(db.Integer, db.ForeignKey("sample.id"), primary_key=True)
     filesize = db.Column(db.Integer, nullable=False)
@@ -73,6 +110,8 @@ class Metadata(db.Model):
     aspect_ratio = db.Column(db.String, nullable=False)
     framerate = db.Column(db.Float, nullable=False)
     codec = db.Column(db.String, nullable=False)
+    # every stream ffprobe reported, as a list of dicts
+    streams = db.Column(db.JSON, nullable=True)
 
     sample = db.relationship("Sample", back_populates="sample_metadata")
 
@@ -85,9 +124,34 @@ class TagCategory(db.Model):
 
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False, unique=True, index=True)
     description = db.Column(db.String, nullable=True)
     category_id = db.Column(db.Integer, db.ForeignKey("tag_category.id"), nullable=False)
 
     category = db.relationship("TagCategory", back_populates="tags")
-    samples = db.relationship("Sample", secondary=tags_table, back_populates="tags")
\ No newline at end of file
+    samples = db.relationship("Sample", secondary=tags_table, back_populates="tags")
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    # not a foreign key, failed uploads delete their sample but keep the job around for /api/jobs
+    sample_id = db.Column(db.Integer, nullable=True, index=True)
+    status = db.Column(db.String(16), nullable=False, default="queued", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    error = db.Column(db.String, nullable=True)
+    # share of the work done (0 to 1), for jobs that report it
+    progress = db.Column(db.Float, nullable=True)
+    run_after = db.Column(TIMESTAMP(timezone=True), nullable=False)
+    created_at = db.Column(TIMESTAMP(timezone=True), nullable=False)
+    updated_at = db.Column(TIMESTAMP(timezone=True), nullable=False)
+
+# what a worker claims next
+_queued = Job.status == "queued"
+db.Index("ix_job_queued_run_after", Job.run_after, postgresql_where=_queued, sqlite_where=_queued)
+
+class CatalogCounter(db.Model):
+    # public sample counts kept up to date by counters.py, scope is "public", "source", "uploader" or "tag"
+    scope = db.Column(db.String(16), primary_key=True)
+    ref_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,212 @@
+import os
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app, g, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from config import SQL_PROFILER
+
+# a statement shape seen this many times in one request is reported as a likely N+1
+REPEAT_THRESHOLD = 3
+# how many request reports /_debug/sql keeps
+REPORTS_KEPT = 50
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_local = threading.local()
+_reports = OrderedDict()
+_reports_lock = threading.Lock()
+_installed = False
+_install_lock = threading.Lock()
+
+
+class TooManyQueries(AssertionError):
+    pass
+
+
+def _shape(statement):
+    # the same query with different values or IN list lengths has the same shape
+    shape = re.sub(r"\s+", " ", statement).strip()
+    shape = re.sub(r"'(?:[^']|'')*'", "?", shape)
+    shape = re.sub(r"\b\d+(?:\.\d+)?\b", "?", shape)
+    shape = re.sub(r"\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)", "(?, ...)", shape)
+    return shape
+
+
+def _call_site():
+    """The innermost frame of our own code that ran the statement, and the template it was rendered from, if any."""
+    site = None
+    template = None
+    for frame in reversed(traceback.extract_stack()):
+        filename = frame.filename
+        if filename == __file__ or not filename.startswith(ROOT) or "site-packages" in filename:
+            continue
+        if filename.endswith(".html"):
+            # jinja compiles templates with their own filename, lines don't map back to the source though
+            template = template or os.path.relpath(filename, ROOT)
+            continue
+        if site is None:
+            site = f"{os.path.relpath(filename, ROOT)}:{frame.lineno} in {frame.name}"
+    return site, template
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, "collectors", None):
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    collectors = getattr(_local, "collectors", None)
+    if not collectors or not conn.info.get("profile_start"):
+        return
+    duration = time.perf_counter() - conn.info["profile_start"].pop()
+    site, template = _call_site()
+    record = {
+        "statement": statement,
+        "shape": _shape(statement),
+        "ms": round(duration * 1000, 3),
+        "site": site,
+        "template": template,
+    }
+    for records in collectors:
+        records.append(record)
+
+
+def _install():
+    global _installed
+    with _install_lock:
+        if not _installed:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            _installed = True
+
+
+def start():
+    """Starts recording the statements run on this thread, returns the list they're added to."""
+    _install()
+    records = []
+    _local.__dict__.setdefault("collectors", []).append(records)
+    return records
+
+
+def stop(records):
+    collectors = getattr(_local, "collectors", [])
+    if records in collectors:
+        collectors.remove(records)
+    return records
+
+
+@contextmanager
+def collect():
+    records = start()
+    try:
+        yield records
+    finally:
+        stop(records)
+
+
+def summarize(records):
+    """Totals, repeated statement shapes (likely N+1s) with where they came from, and every statement."""
+    shapes = OrderedDict()
+    for record in records:
+        shape = shapes.setdefault(record["shape"], {"shape": record["shape"], "count": 0, "ms": 0.0, "sources": set()})
+        shape["count"] += 1
+        shape["ms"] += record["ms"]
+        shape["sources"].add(record["template"] or record["site"] or "?")
+    repeated = [
+        {**shape, "ms": round(shape["ms"], 3), "sources": sorted(shape["sources"])}
+        for shape in shapes.values()
+        if shape["count"] >= REPEAT_THRESHOLD
+    ]
+    return {
+        "queries": len(records),
+        "ms": round(sum(record["ms"] for record in records), 3),
+        "repeated": sorted(repeated, key=lambda shape: -shape["count"]),
+        "statements": records,
+    }
+
+
+@contextmanager
+def max_queries(limit):
+    """Raises TooManyQueries if the block runs more than limit statements. For checking a route's query budget:
+
+        with profiler.max_queries(12):
+            app.test_client().get("/tags/")
+    """
+    with collect() as records:
+        yield records
+    if len(records) > limit:
+        summary = summarize(records)
+        repeated = "".join(f"\n  {shape['count']}x {shape['shape']} ({', '.join(shape['sources'])})" for shape in summary["repeated"])
+        raise TooManyQueries(f"{len(records)} queries, expected at most {limit}{repeated}")
+
+
+def _enabled():
+    return (current_app.debug or SQL_PROFILER) and request.endpoint not in ("static", "sql_reports", "sql_report")
+
+
+def init_app(app):
+    """Profiles every request in debug mode (or with sql_profiler = true): a summary goes in the
+    X-SQL-Profile header and the full report is kept for /_debug/sql/<id>."""
+
+    @app.before_request
+    def start_profile():
+        if _enabled():
+            g.sql_profile = start()
+
+    @app.after_request
+    def finish_profile(response):
+        records = g.pop("sql_profile", None)
+        if records is None:
+            return response
+        stop(records)
+        summary = summarize(records)
+        summary["endpoint"] = request.endpoint
+        summary["path"] = request.full_path.rstrip("?")
+
+        with _reports_lock:
+            report_id = str(int(time.time() * 1000))
+            while report_id in _reports:
+                report_id = str(int(report_id) + 1)
+            _reports[report_id] = summary
+            while len(_reports) > REPORTS_KEPT:
+                _reports.popitem(last=False)
+
+        for shape in summary["repeated"]:
+            print(f"Possible N+1 on {request.endpoint}: {shape['count']}x {shape['shape']} from {', '.join(shape['sources'])}")
+        response.headers["X-SQL-Profile"] = f"{summary['queries']} queries; {summary['ms']} ms; {len(summary['repeated'])} repeated"
+        response.headers["X-SQL-Report"] = f"/_debug/sql/{report_id}"
+        return response
+
+    @app.teardown_request
+    def drop_profile(_):
+        # after_request doesn't run when the view raised
+        records = g.pop("sql_profile", None)
+        if records is not None:
+            stop(records)
+
+    @app.route("/_debug/sql", endpoint="sql_reports")
+    def sql_reports():
+        if not (current_app.debug or SQL_PROFILER):
+            return jsonify({"error": "Not found"}), 404
+        with _reports_lock:
+            return jsonify([
+                {"id": report_id, "path": report["path"], "queries": report["queries"], "ms": report["ms"], "repeated": len(report["repeated"])}
+                for report_id, report in reversed(_reports.items())
+            ])
+
+    @app.route("/_debug/sql/<report_id>", endpoint="sql_report")
+    def sql_report(report_id):
+        if not (current_app.debug or SQL_PROFILER):
+            return jsonify({"error": "Not found"}), 404
+        with _reports_lock:
+            report = _reports.get(report_id)
+        if report is None:
+            return jsonify({"error": "Report not found"}), 404
+        return jsonify(report)
@@ -0,0 +1,73 @@
+import contextvars
+import functools
+import time
+
+from flask import g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy.orm import Query
+
+from config import REPLICA_STICKY_SECONDS
+
+_reads_ok = contextvars.ContextVar("replica_reads_ok", default=False)
+
+
+def _pinned_to_primary():
+    # the user wrote something a moment ago, the replica might not have it yet
+    return has_request_context() and g.get("pinned_to_primary", False)
+
+
+class RoutingSession(Session):
+    """Sends SELECTs from reads_from_replica helpers to the "replica" bind, when there is one.
+
+    Everything else goes to the primary: writes, reads outside those helpers, and every read
+    after this session (or, for a few seconds, this user) wrote something.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and "replica" in self._db.engines:
+            if getattr(clause, "is_select", False):
+                wanted = _reads_ok.get() or clause._execution_options.get("replica", False)
+                if wanted and not self.info.get("wrote") and not _pinned_to_primary():
+                    return self._db.engines["replica"]
+            elif self._flushing or getattr(clause, "is_dml", False):
+                self.info["wrote"] = True
+                if has_request_context():
+                    g.db_wrote = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def reads_from_replica(fn):
+    """Marks a read-only helper whose results may lag the primary by a little.
+
+    A Query it returns keeps the mark, so it goes to the replica wherever it's run.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _reads_ok.set(True)
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            _reads_ok.reset(token)
+        if isinstance(result, Query):
+            result = result.execution_options(replica=True)
+        return result
+
+    return wrapper
+
+
+def init_app(app):
+    """Keeps a user who just wrote something (an upload, a like, an edit) on the primary for
+    replica_sticky_seconds, so they see their own change even if the replica is behind."""
+    if "replica" not in app.config.get("SQLALCHEMY_BINDS", {}):
+        return
+
+    @app.before_request
+    def check_pinned():
+        g.pinned_to_primary = session.get("primary_until", 0) > time.time()
+
+    @app.after_request
+    def pin_writers(response):
+        if g.get("db_wrote"):
+            session["primary_until"] = time.time() + REPLICA_STICKY_SECONDS
+        return response
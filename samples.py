@@ -1,53 +1,71 @@
 import datetime
 import os
-import re
 import pathlib
 import secrets
-import file_type
 
 from flask import jsonify
 from flask_login import current_user
+from sqlalchemy.orm import selectinload
 
-from config import MB_UPLOAD_LIMIT
-from models import Metadata, Sample, db, Tag
-from utils import add_sample_to_db, check_video, create_thumbnail, reencode_video, add_tag_to_db, update_metadata
+import cache
+import counters
+import metrics
+from encoder import reencode_video
+
+from ingest import ingest, ALLOWED_UPLOAD_EXTENSIONS, ALLOWED_UPLOAD_EXTENSIONS_WITH_REENCODE, UNSUPPORTED_MESSAGE
+from jobs import enqueue, enqueue_many, job_handler, cancel_sample_jobs, PermanentJobError
+from models import Job, Metadata, Sample, db, likes_table
+from utils import add_sample_to_db, check_video, create_thumbnail, update_metadata, hash_file, resolve_tags, set_sample_tags, dialect_insert
 
 from werkzeug.utils import secure_filename
 
-ALLOWED_UPLOAD_EXTENSIONS=["mp4"]
-ALLOWED_UPLOAD_EXTENSIONS_WITH_REENCODE=["m4v"]
 
+# category that tags first used while editing a sample are created in
+NEW_TAG_CATEGORY = 5
 
 def edit_sample(sample_id, filename, source_id, tags, reencode):
-    sample = Sample.query.get(sample_id)
-    if not sample:
+    return edit_samples([(sample_id, filename, source_id, tags)], reencode)
+
+def edit_samples(edits, reencode):
+    """Applies a batch of (sample_id, filename, source_id, tags) edits in one transaction, returns 1 if it failed.
+
+    Tags are resolved and the association rows replaced for the whole batch at once,
+    so the number of queries doesn't grow with the number of samples or tags.
+    """
+    try:
+        sample_ids = [int(sample_id) for sample_id, _, _, _ in edits]
+    except ValueError:
         return 1
+    found = {
+        sample.id: sample
+        for sample in Sample.query.options(selectinload(Sample.tags)).filter(Sample.id.in_(sample_ids)).all()
+    }
+    if len(found) != len(set(sample_ids)):
+        return 1
+    counted = {sample_id: counters.snapshot(sample) for sample_id, sample in found.items()}
 
-    if reencode:
-        reencode_video(sample.stored_as)
-        update_metadata(sample.id)
-
-    sample.filename = filename
-    sample.source_id = source_id
-
-    sample.tags = [] # clear tags in the case of re-edits
-    for sample_tag in tags:
-        tag = Tag.query.filter_by(name=sample_tag).first()
-        if tag is None:
-            if sample_tag == '':
-                continue
-            add_tag_to_db(sample_tag, 5)
-            tag = Tag.query.filter_by(name=sample_tag).first()
-        if tag not in sample.tags:
-            sample.tags.append(tag)
-    
     try:
+        tag_ids = resolve_tags({name for _, _, _, tags in edits for name in tags}, NEW_TAG_CATEGORY)
+        new_tags = {}
+        for sample_id, (_, filename, source_id, tags) in zip(sample_ids, edits):
+            sample = found[sample_id]
+            sample.filename = filename
+            sample.source_id = source_id
+            # tags are replaced as a whole, so re-edits drop the ones that were removed
+            new_tags[sample_id] = {tag_ids[name] for name in tags if name}
+        set_sample_tags(new_tags)
+        counters.update_many([
+            (counted[sample_id], counters.snapshot(found[sample_id], new_tags[sample_id])) for sample_id in found
+        ])
+        if reencode:
+            enqueue_many("reencode", sorted(found), commit=False)
         db.session.commit()
     except Exception as e:
         print(e)
         db.session.rollback()
         return 1
 
+    cache.invalidate("home")
     return 0
 
 def upload(file):
@@ -59,49 +77,40 @@ def upload(file):
         if len(filename) >= 100:
             raise Exception("Filename must not exceed 100 bytes")
 
-        random_id = secrets.token_hex(10)
-        
-        stored_as = f"{filename}_{random_id}.mp4"
-        stored_as = re.sub(r"[^\w\s.-]", "", stored_as)
-
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S%f")[:-3]
-
         # Make sure the directories actually exist
         pathlib.Path("static/media/samps").mkdir(parents=True,exist_ok=True)
         pathlib.Path("static/media/thumbs").mkdir(parents=True,exist_ok=True)
 
-        upload_path = os.path.join("static/media/samps", stored_as)
-        file.save(upload_path)
-
-        ext = file_type.filetype_from_file(upload_path).extensions()
-        invalid_file = True
-        for allowed_ext in ALLOWED_UPLOAD_EXTENSIONS:
-            if allowed_ext in ext:
-                invalid_file = False
-                break
-        
-        # if we hit an invalid file, go through the extensions that can be submitted but with a reencode
-        if invalid_file:
-            for allowed_ext in ALLOWED_UPLOAD_EXTENSIONS_WITH_REENCODE:
-                if allowed_ext in ext:
-                    invalid_file = False
-                    force_reencode = True
-                    break
+        # by now the upload has already been streamed to a temp file, hashed, size checked and sniffed
+        ingested = ingest(file)
+        if ingested.error:
+            raise Exception(ingested.error)
+
+        ext = ingested.extension
+        invalid_file = ext not in ALLOWED_UPLOAD_EXTENSIONS
 
+        # if we hit an invalid file, go through the extensions that can be submitted but with a reencode
+        if invalid_file and ext in ALLOWED_UPLOAD_EXTENSIONS_WITH_REENCODE:
+            invalid_file = False
+            force_reencode = True
 
-        if not check_video(upload_path):
-            invalid_file = True
-            
         if invalid_file:
-            os.remove(upload_path)
-            raise Exception("There is an error one of your files. Please make sure it is a valid .mp4 file.")
-        
-        if os.path.getsize(upload_path) > MB_UPLOAD_LIMIT * 1000 * 1000:
-            os.remove(upload_path)
-            raise Exception("One or more of your sample(s) exceeded the file limit. Max supported filesize is 10MB per file.")
+            ingested.close()
+            raise Exception(UNSUPPORTED_MESSAGE)
 
-        thumbnail_filename = f"{timestamp}.png"
-        create_thumbnail(upload_path, f"static/media/thumbs/{thumbnail_filename}")
+        # files are stored under their hash, so a re-upload of a clip we already have
+        # shares the existing file, thumbnail and metadata instead of processing it all again
+        content_hash = ingested.sha256
+        duplicate = find_duplicate(content_hash)
+        if duplicate:
+            ingested.close()
+            stored_as = duplicate.stored_as
+            thumbnail_filename = duplicate.thumbnail_filename
+        else:
+            stored_as = f"{content_hash}.mp4"
+            thumbnail_filename = f"{content_hash}.png"
+            ingested.commit(os.path.join("static/media/samps", stored_as))
+        upload_path = os.path.join("static/media/samps", stored_as)
 
         is_public = current_user.is_uploader
         
@@ -113,59 +122,273 @@ def upload(file):
                 thumbnail_filename,
                 current_user.id,
                 None,
-                is_public
+                is_public,
+                content_hash,
+                commit=False,
             )
-            update_metadata(sample_id)
+            counters.update({}, Sample.query.get(sample_id))
+            if duplicate:
+                job_kinds = _copy_processed(duplicate, sample_id)
+            else:
+                job_kinds = ("probe", "thumbnail", "metadata")
+            # the slow ffprobe/ffmpeg work happens in the background, in this order.
+            # all of it (and the sample itself) is committed together so a failed probe can't miss cancelling the rest.
+            job_ids = [enqueue(kind, sample_id, commit=False) for kind in job_kinds]
+            db.session.commit()
+            cache.invalidate("home")
+            metrics.inc("upload_bytes_total", ingested.size)
         except Exception as e:
             print(e)
-            if os.path.exists(upload_path):
+            db.session.rollback()
+            if not duplicate and not Sample.query.filter_by(stored_as=stored_as).count() and os.path.exists(upload_path):
                 os.remove(upload_path)
-            thumb_path = f"static/media/thumbs/{thumbnail_filename}"
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
             raise Exception(f"Failed to add sample to database: {e}")
 
     else:
         raise Exception("No file")
 
-    return sample_id, original_filename, timestamp, stored_as, force_reencode
+    return sample_id, original_filename, thumbnail_filename, stored_as, force_reencode, job_ids
+
+def upload_batch(files):
+    """Ingests each file of a batch on its own, so one bad file neither stops nor undoes the others.
+
+    Returns a dict per file in the same order, with either the sample and its jobs or an "error".
+    Only the quick part (storing the file and its row) happens here, probing and thumbnailing
+    run on the job workers, so the files of a batch are processed side by side.
+    """
+    results = []
+    for file in files:
+        try:
+            sample_id, original_filename, thumbnail_filename, stored_as, force_reencode, job_ids = upload(file)
+        except Exception as ex:
+            metrics.inc("uploads_total", outcome="error")
+            results.append({"filename": file.filename, "error": str(ex)})
+            continue
+        metrics.inc("uploads_total", outcome="ok")
+        results.append({
+            "filename": original_filename,
+            "sample_id": sample_id,
+            "thumbnail_filename": thumbnail_filename,
+            "stored_as": stored_as,
+            "force_reencode": force_reencode,
+            "jobs": job_ids,
+        })
+    return results
+
+def find_duplicate(content_hash):
+    """Returns a sample already stored with the same content, if its file is still around."""
+    for sample in Sample.query.filter_by(content_hash=content_hash).order_by(Sample.id).all():
+        if os.path.exists(_sample_path(sample)):
+            return sample
+    return None
+
+def _copy_processed(duplicate, sample_id):
+    # reuse whatever the original upload already has, returns the jobs still needed for the rest
+    job_kinds = []
+    if not _probed(duplicate):
+        job_kinds.append("probe")
+    metadata = Metadata.query.get(duplicate.id)
+    if metadata:
+        db.session.add(Metadata(
+            sample_id=sample_id,
+            filesize=metadata.filesize,
+            width=metadata.width,
+            height=metadata.height,
+            aspect_ratio=metadata.aspect_ratio,
+            framerate=metadata.framerate,
+            codec=metadata.codec,
+            streams=metadata.streams,
+        ))
+    else:
+        job_kinds.append("metadata")
+    if not os.path.exists(os.path.join("static/media/thumbs", duplicate.thumbnail_filename)):
+        job_kinds.append("thumbnail")
+    return job_kinds
+
+def _probed(sample):
+    """Whether the file of sample has been checked to be a usable video.
+
+    Samples from before the probe job were checked during their upload, so they have no probe jobs at all.
+    """
+    same_file = db.session.query(Sample.id).filter(Sample.stored_as == sample.stored_as)
+    probes = db.session.query(Job.status).filter(Job.kind == "probe", Job.sample_id.in_(same_file)).all()
+    return not probes or any(status == "done" for status, in probes)
+
+def _remove_unreferenced_files(sample):
+    """Removes the files of a deleted sample that no other sample shares, returns warnings for missing files."""
+    warnings = []
+    if not Sample.query.filter_by(thumbnail_filename=sample.thumbnail_filename).count():
+        try:
+            os.remove(os.path.join("static/media/thumbs", sample.thumbnail_filename))
+        except FileNotFoundError as _:
+            warnings.append("Thumbnail file wasn't found, couldn't be deleted")
+        try:
+            os.remove(os.path.join("static/media/thumbs", sample.small_thumbnail_filename))
+        except FileNotFoundError as _:
+            pass
+    if not Sample.query.filter_by(stored_as=sample.stored_as).count():
+        try:
+            os.remove(_sample_path(sample))
+        except FileNotFoundError as _:
+            warnings.append("Sample file wasn't found, couldn't be deleted")
+    return warnings
+
+def _sample_path(sample):
+    return os.path.join("static/media/samps", sample.stored_as)
+
+def _get_job_sample(sample_id):
+    sample = Sample.query.get(sample_id)
+    if not sample:
+        raise PermanentJobError(f"Sample {sample_id} no longer exists")
+    return sample
+
+def _discard_upload(sample_id):
+    # the upload was never a usable video, so drop it entirely like a rejected upload used to be.
+    # every sample sharing the same file is just as broken, so they go too.
+    sample = Sample.query.get(sample_id)
+    if not sample:
+        cancel_sample_jobs(sample_id)
+        return
+    broken = Sample.query.filter_by(stored_as=sample.stored_as).all()
+    for broken_sample in broken:
+        cancel_sample_jobs(broken_sample.id)
+        counters.update(counters.snapshot(broken_sample), None)
+        metadata = Metadata.query.get(broken_sample.id)
+        if metadata is not None:
+            db.session.delete(metadata)
+        db.session.delete(broken_sample)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    cache.invalidate("home")
+    _remove_unreferenced_files(sample)
+
+@job_handler("probe", on_failure=_discard_upload)
+def probe_job(sample_id):
+    sample = _get_job_sample(sample_id)
+    if not check_video(_sample_path(sample)):
+        raise PermanentJobError("There is an error with this file. Please make sure it is a valid .mp4 file.")
+
+@job_handler("thumbnail")
+def thumbnail_job(sample_id):
+    sample = _get_job_sample(sample_id)
+    if not create_thumbnail(
+        _sample_path(sample),
+        f"static/media/thumbs/{sample.thumbnail_filename}",
+        f"static/media/thumbs/{sample.small_thumbnail_filename}",
+    ):
+        raise Exception("Failed to create thumbnail")
+
+@job_handler("metadata")
+def metadata_job(sample_id):
+    _get_job_sample(sample_id)
+    update_metadata(sample_id)
+
+@job_handler("reencode")
+def reencode_job(sample_id):
+    sample = _get_job_sample(sample_id)
+    # the reencode goes to a new file named after its own hash, since the original may be shared with other samples
+    output = os.path.join("static/media/samps", f"temp_{sample_id}_{secrets.token_hex(4)}.mp4")
+    # raises (and cleans up output) on failure or timeout, or asks to be retried later when no slot is free
+    reencode_video(sample.stored_as, output, sample_id)
+
+    content_hash = hash_file(output)
+    stored_as = f"{content_hash}.mp4"
+    os.replace(output, os.path.join("static/media/samps", stored_as))
+
+    old_stored_as = sample.stored_as
+    sample.stored_as = stored_as
+    sample.content_hash = content_hash
+    db.session.commit()
+    cache.invalidate("home")
+    if old_stored_as != stored_as and not Sample.query.filter_by(stored_as=old_stored_as).count():
+        os.remove(os.path.join("static/media/samps", old_stored_as))
+    enqueue("metadata", sample_id)
 
 def delete_sample(sample_id):
     # (note: we do not need err_sanitize here as these errors should only be visible to admins)
     try:
         sample = Sample.query.get(sample_id)
     except Exception as ex:
+        db.session.rollback()
         return jsonify({"success": False, "message": "Sample could not be deleted: "+str(ex)})
     if sample:
         try:
             metadata = Metadata.query.get(sample_id)
         except Exception as ex:
+            db.session.rollback()
             return jsonify({"success": False, "message": "Sample could not be deleted: "+str(ex)})
         if sample:
-            try:
-                db.session.delete(metadata)
-            except Exception as ex:
-                return jsonify({"success": False, "message": "Sample metadata could not be deleted: "+str(ex)})
+            counted = counters.snapshot(sample)
+            # the metadata job may not have run yet, or may have failed
+            if metadata is not None:
+                try:
+                    db.session.delete(metadata)
+                except Exception as ex:
+                    db.session.rollback()
+                    return jsonify({"success": False, "message": "Sample metadata could not be deleted: "+str(ex)})
             try:
                 db.session.delete(sample)
             except Exception as ex:
+                db.session.rollback()
                 return jsonify({"success": False, "message": "Sample could not be deleted: "+str(ex)})
             try: 
+                counters.update(counted, None)
                 db.session.commit()
+                cancel_sample_jobs(sample_id)
+                cache.invalidate("home")
             except Exception as ex:
+                db.session.rollback()
                 return jsonify({"success": False, "message": "Sample deletion could not be committed: "+str(ex)})
                 
-            warnings = []
-            try:
-                os.remove(os.path.join("static/media/thumbs", sample.thumbnail_filename))
-            except FileNotFoundError as _:
-                warnings.append("Thumbnail file wasn't found, couldn't be deleted")
-            try:
-                os.remove(os.path.join("static/media/samps", sample.stored_as))
-            except FileNotFoundError as _:
-                warnings.append("Sample file wasn't found, couldn't be deleted")
+            warnings = _remove_unreferenced_files(sample)
 
         return jsonify({"success": False, "message": "Sample deleted successfully.", "warnings": warnings})
     
     return jsonify({"success": False, "message": "Tried to delete a sample that doesn't exist."})
 
+def publish_sample(sample_id, is_public=True):
+    sample = Sample.query.get(sample_id)
+    if not sample:
+        return jsonify({"success": False, "message": "Tried to publish a sample that doesn't exist."})
+    counted = counters.snapshot(sample)
+    sample.is_public = is_public
+    try:
+        counters.update(counted, sample)
+        db.session.commit()
+    except Exception as ex:
+        db.session.rollback()
+        return jsonify({"success": False, "message": "Sample could not be published: "+str(ex)})
+    cache.invalidate("home")
+    return jsonify({"success": True, "message": "Sample published." if is_public else "Sample unpublished."})
+
+def toggle_like(sample_id, user_id):
+    """Likes the sample for the user, or unlikes it if they already did. Returns (liked, like_count).
+
+    A single delete or insert on the likes table plus one counter update, no matter how many likes the sample has.
+    """
+    where = (likes_table.c.sample_id == sample_id) & (likes_table.c.user_id == user_id)
+    if db.session.execute(likes_table.delete().where(where)).rowcount:
+        liked, delta = False, -1
+    else:
+        row = {"sample_id": sample_id, "user_id": user_id}
+        insert = dialect_insert()
+        if insert is not None:
+            # a double click that raced us already added it, which still leaves the sample liked
+            inserted = db.session.execute(insert(likes_table).values(row).on_conflict_do_nothing()).rowcount
+        else:
+            inserted = db.session.execute(likes_table.insert().values(row)).rowcount
+        liked, delta = True, 1 if inserted else 0
+
+    stmt = db.update(Sample).where(Sample.id == sample_id).values(like_count=Sample.like_count + delta)
+    if db.session.get_bind().dialect.update_returning:
+        like_count = db.session.execute(stmt.returning(Sample.like_count)).scalar()
+    else:
+        db.session.execute(stmt)
+        like_count = db.session.query(Sample.like_count).filter(Sample.id == sample_id).scalar()
+    db.session.commit()
+    if delta:
+        cache.invalidate("home")
+    return liked, like_count
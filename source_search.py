@@ -0,0 +1,183 @@
+import bisect
+import heapq
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import case, func, or_, text
+
+from models import CatalogCounter, Source, db
+
+# how many sources a lookup returns
+RESULT_LIMIT = 50
+# typeahead fires a lookup per keystroke, so identical lookups are answered from memory for a little while
+RESULT_TTL = 30
+RESULT_CACHE_SIZE = 1024
+# how long the in-memory n-gram index is used before it's rebuilt to pick up new sources and sample counts
+INDEX_TTL = 300
+# minimum share of trigrams two names need in common to count as a fuzzy match, same default as pg_trgm
+SIMILARITY_THRESHOLD = 0.3
+
+SourceMatch = namedtuple("SourceMatch", ["id", "name", "samples"])
+
+_use_trgm = False
+_lock = threading.Lock()
+_results = OrderedDict()
+_index = None
+_index_built = 0
+
+
+def _trigrams(value):
+    # padded the same way pg_trgm does, so short names and word starts still produce trigrams
+    value = f"  {value.lower()} "
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def _escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class NgramIndex:
+    """In-memory prefix and trigram index over source names, for databases without pg_trgm.
+
+    Entries are kept in ranking order (most public samples first), so an entry's position is its rank.
+    """
+
+    def __init__(self, rows):
+        self.entries = sorted((SourceMatch(*row) for row in rows), key=lambda entry: (-entry.samples, entry.name))
+        self.sorted_names = sorted((entry.name.lower(), i) for i, entry in enumerate(self.entries))
+        self.grams = [_trigrams(entry.name) for entry in self.entries]
+        self.postings = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(i)
+
+    def _postings(self, gram):
+        return self.postings.get(gram, set())
+
+    def search(self, query, limit=RESULT_LIMIT):
+        query = query.lower()
+
+        start = bisect.bisect_left(self.sorted_names, (query, -1))
+        end = bisect.bisect_left(self.sorted_names, (query + "\U0010ffff", -1), start)
+        prefix = [i for _, i in self.sorted_names[start:end]]
+        # prefix matches always rank first, so there's nothing else to do once they fill the page
+        if len(prefix) >= limit:
+            return [self.entries[i] for i in heapq.nsmallest(limit, prefix)]
+
+        candidates = set()
+
+        # substrings contain every inner trigram of the query, start intersecting from the rarest
+        inner = sorted((query[i:i + 3] for i in range(len(query) - 2)), key=lambda gram: len(self._postings(gram)))
+        if inner:
+            contains = set(self._postings(inner[0]))
+            for gram in inner[1:]:
+                contains &= self._postings(gram)
+            candidates |= {i for i in contains if query in self.entries[i].name.lower()}
+
+        # a name similar enough has to share at least `needed` trigrams with the query,
+        # so it's enough to look at the rarest ones that many can't all be missed from
+        query_grams = _trigrams(query)
+        needed = max(1, math.ceil(SIMILARITY_THRESHOLD * len(query_grams)))
+        rarest = sorted(query_grams, key=lambda gram: len(self._postings(gram)))[:len(query_grams) - needed + 1]
+        similarity = {}
+        for i in set().union(*(self._postings(gram) for gram in rarest)):
+            shared = len(query_grams & self.grams[i])
+            similarity[i] = shared / (len(query_grams) + len(self.grams[i]) - shared)
+            if similarity[i] >= SIMILARITY_THRESHOLD:
+                candidates.add(i)
+
+        candidates -= set(prefix)
+        others = sorted(candidates, key=lambda i: (-self.entries[i].samples, -similarity.get(i, 1.0), i))
+        return [self.entries[i] for i in sorted(prefix) + others[:limit - len(prefix)]]
+
+
+def _public_counts():
+    return CatalogCounter.__table__.alias("counts")
+
+
+def _build_index():
+    counts = _public_counts()
+    rows = (
+        db.session.query(Source.id, Source.name, func.coalesce(counts.c.value, 0))
+        .outerjoin(counts, (counts.c.scope == "source") & (counts.c.ref_id == Source.id))
+        .all()
+    )
+    return NgramIndex(rows)
+
+
+def _search_index(query):
+    global _index, _index_built
+    with _lock:
+        index = _index
+        if index is None or time.monotonic() - _index_built > INDEX_TTL:
+            index = None
+    if index is None:
+        index = _build_index()
+        with _lock:
+            _index, _index_built = index, time.monotonic()
+    return index.search(query)
+
+
+def _search_trgm(query):
+    pattern = _escape_like(query)
+    prefix = Source.name.ilike(f"{pattern}%", escape="\\")
+    similarity = func.similarity(Source.name, query)
+    counts = _public_counts()
+    samples = func.coalesce(counts.c.value, 0)
+    rows = (
+        db.session.query(Source.id, Source.name, samples)
+        .outerjoin(counts, (counts.c.scope == "source") & (counts.c.ref_id == Source.id))
+        .filter(or_(prefix, Source.name.ilike(f"%{pattern}%", escape="\\"), Source.name.op("%")(query)))
+        .order_by(case((prefix, 1), else_=0).desc(), samples.desc(), similarity.desc(), Source.name)
+        .limit(RESULT_LIMIT)
+        .all()
+    )
+    return [SourceMatch(*row) for row in rows]
+
+
+def search(query):
+    """Sources matching query by prefix, substring or trigram similarity, prefix matches first then by public sample count."""
+    query = query.strip()
+    if not query:
+        return []
+
+    key = query.lower()
+    now = time.monotonic()
+    with _lock:
+        cached = _results.get(key)
+        if cached is not None and now - cached[0] < RESULT_TTL:
+            _results.move_to_end(key)
+            return cached[1]
+
+    results = _search_trgm(query) if _use_trgm else _search_index(query)
+
+    with _lock:
+        _results[key] = (now, results)
+        _results.move_to_end(key)
+        while len(_results) > RESULT_CACHE_SIZE:
+            _results.popitem(last=False)
+    return results
+
+
+def invalidate():
+    """Drops cached results and the in-memory index, for after sources are added or renamed."""
+    global _index
+    with _lock:
+        _results.clear()
+        _index = None
+
+
+def init_app(app):
+    """Uses pg_trgm on a Postgres that has it (the migrations install it and its index), anything else uses the n-gram index."""
+    global _use_trgm
+    with app.app_context():
+        if db.engine.dialect.name != "postgresql":
+            return
+        try:
+            _use_trgm = db.session.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() is not None
+        finally:
+            db.session.rollback()
+        if not _use_trgm:
+            print("pg_trgm isn't installed (run flask db upgrade), falling back to the in-memory source index")
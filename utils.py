@@ -1,10 +1,79 @@
+import datetime
+import hashlib
 import os
+import threading
+from collections import OrderedDict
 
 import ffmpeg
-import shutil
-from models import Sample, Metadata, Tag, db
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Sample, Metadata, Tag, db, likes_table, tags_table
+import metrics
 
-def add_sample_to_db(filename, stored_as, upload_date, thumbnail, uploader, source_id, is_public):
+# height of the WebP thumbnail shown in sample grids, the full one is always 480p
+SMALL_THUMBNAIL_HEIGHT = 240
+
+# how many probe results are kept around, one upload goes through a handful of probes at most
+PROBE_CACHE_SIZE = 256
+
+_probe_cache = OrderedDict()
+_probe_cache_lock = threading.Lock()
+
+
+class ProbeResult:
+    """The parsed output of one ffprobe run, shared by validation, metadata, thumbnailing and reencoding."""
+
+    def __init__(self, probe):
+        self.format = probe["format"]
+        self.streams = probe["streams"]
+
+    def _first_stream(self, codec_type):
+        return next((stream for stream in self.streams if stream.get("codec_type") == codec_type), None)
+
+    @property
+    def video_stream(self):
+        return self._first_stream("video")
+
+    @property
+    def audio_stream(self):
+        return self._first_stream("audio")
+
+    @property
+    def size(self):
+        return int(self.format["size"])
+
+    @property
+    def duration(self):
+        duration = self.format.get("duration")
+        return float(duration) if duration is not None else None
+
+
+def probe_video(path):
+    """Runs ffprobe on path, or returns the cached result if the file hasn't changed since the last probe.
+
+    Raises ffmpeg.Error if the file can't be probed.
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    with _probe_cache_lock:
+        cached = _probe_cache.get(path)
+        if cached is not None and cached[0] == key:
+            _probe_cache.move_to_end(path)
+            return cached[1]
+
+    with metrics.ffmpeg_timer("probe"):
+        result = ProbeResult(ffmpeg.probe(path))
+
+    with _probe_cache_lock:
+        _probe_cache[path] = (key, result)
+        _probe_cache.move_to_end(path)
+        while len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return result
+
+
+def add_sample_to_db(filename, stored_as, upload_date, thumbnail, uploader, source_id, is_public, content_hash=None, commit=True):
     try:
         sample = Sample(
             filename=filename,
@@ -14,9 +83,13 @@ def add_sample_to_db(filename, stored_as, upload_date, thumbnail, uploader, sour
             uploader=uploader,
             source_id=source_id,
             is_public=is_public,
+            content_hash=content_hash,
         )
         db.session.add(sample)
-        db.session.commit()
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
         return sample.id
     except Exception as e:
         db.session.rollback()
@@ -30,12 +103,8 @@ def update_metadata(sample_id):
         if not sample:
             raise ValueError(f"Sample with id {sample_id} not found")
 
-        metadata = get_metadata(sample_id)
-        video_stream = None
-        for stream in metadata['streams']:
-            if stream['codec_type'] == "video":
-                video_stream = stream
-                break
+        probe = get_metadata(sample_id)
+        video_stream = probe.video_stream
 
         if not video_stream:
             raise ValueError("No video stream found in metadata")
@@ -45,14 +114,17 @@ def update_metadata(sample_id):
 
         sample_metadata = Metadata(
             sample_id=sample.id,
-            filesize=metadata['format']['size'],
+            filesize=probe.size,
             width=video_stream['width'],
             height=video_stream['height'],
             aspect_ratio=video_stream['display_aspect_ratio'],
             framerate=framerate,
             codec=video_stream['codec_name'],
+            streams=probe.streams,
         )
-        db.session.add(sample_metadata)
+        # merge so a reencode can overwrite the metadata of the original upload
+        db.session.merge(sample_metadata)
+        sample.updated_at = datetime.datetime.now(datetime.UTC)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
@@ -60,88 +132,151 @@ def update_metadata(sample_id):
         raise ValueError(f"Error adding metadata: {e}")
 
 
-def create_thumbnail(video_path, thumbnail_path):
-    shutil.copy(video_path, os.getcwd())
+def create_thumbnail(video_path, thumbnail_path, small_thumbnail_path=None):
+    """Writes the 480p PNG thumbnail and, if a path is given, the small WebP used by sample grids.
 
+    Both come out of a single ffmpeg run that reads the stored video in place and seeks before decoding.
+    """
     try:
-        if not os.path.exists(os.path.join(os.getcwd(), os.path.basename(video_path))):
-            raise FileNotFoundError(
-                f"Video file not found: {os.path.join(os.getcwd(), os.path.basename(video_path))}"
-            )
+        if probe_video(video_path).video_stream is None:
+            print(f"No video stream to make a thumbnail from in {video_path}")
+            return False
+    except (ffmpeg.Error, FileNotFoundError) as e:
+        print(f"Couldn't probe {video_path} for a thumbnail: {e}")
+        return False
 
-        (
-            ffmpeg.input(os.path.join(os.getcwd(), os.path.basename(video_path)), ss=0)
+    try:
+        frame = (
+            ffmpeg.input(video_path, ss=0)
             .filter("pad", width="max(iw,ih*(16/9))", height="ow/(16/9)", x="(ow-iw)/2", y="(oh-ih)/2")
-            .filter("scale", -1, 480)
-            .output(thumbnail_path, vframes=1)
-            .run(capture_stdout=True, capture_stderr=True)
         )
 
-        os.remove(os.path.join(os.getcwd(), os.path.basename(video_path)))
+        if small_thumbnail_path is None:
+            outputs = frame.filter("scale", -1, 480).output(thumbnail_path, vframes=1)
+        else:
+            split = frame.filter_multi_output("split")
+            outputs = ffmpeg.merge_outputs(
+                split.stream(0).filter("scale", -1, 480).output(thumbnail_path, vframes=1),
+                split.stream(1).filter("scale", -2, SMALL_THUMBNAIL_HEIGHT).output(
+                    small_thumbnail_path, vframes=1, vcodec="libwebp", quality=75
+                ),
+            )
+        with metrics.ffmpeg_timer("thumbnail"):
+            outputs.run(capture_stdout=True, capture_stderr=True, overwrite_output=True)
 
         print(f"Thumbnail saved at {thumbnail_path}")
+        return True
 
-    except Exception as e:
+    except ffmpeg.Error as e:
         print('stdout:', e.stdout.decode('utf8'))
         print('stderr:', e.stderr.decode('utf8'))
         print(f"An error occurred: {e}")
+        return False
+    except OSError as e:
+        print(f"An error occurred: {e}")
+        return False
 
-def add_tag_to_db(name, category_id):
+def recount_likes():
+    # bulk fix for Sample.like_count drifting from the likes table, only touches rows that are off.
+    actual = (
+        select(func.count(likes_table.c.user_id))
+        .where(likes_table.c.sample_id == Sample.id)
+        .scalar_subquery()
+    )
     try:
-        tag = Tag(name=name, category_id=category_id)
-        db.session.add(tag)
+        result = db.session.execute(
+            db.update(Sample)
+            .where(Sample.like_count != actual)
+            .values(like_count=actual)
+            .execution_options(synchronize_session=False)
+        )
         db.session.commit()
+        return result.rowcount
     except Exception as e:
         db.session.rollback()
-        print(f"Error adding tag: {e}")
+        print(f"Error recounting likes: {e}")
         raise
 
+def dialect_insert():
+    """The insert() of the current database if it supports ON CONFLICT (postgres and sqlite), otherwise None."""
+    match db.session.get_bind().dialect.name:
+        case "postgresql":
+            return postgresql.insert
+        case "sqlite":
+            return sqlite.insert
+        case _:
+            return None
 
+def resolve_tags(names, category_id):
+    """Returns {name: id} for the given tag names, creating the missing ones in category_id.
 
-def reencode_video(filename):
-    temp = "temp_" + filename
+    Takes at most three queries however many names there are: one IN lookup, one multi-row
+    insert that skips names someone else created meanwhile, and one lookup of the new ids.
+    Nothing is committed.
+    """
+    names = {name for name in names if name}
+    if not names:
+        return {}
+    tag_ids = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)).all())
+    missing = names - tag_ids.keys()
+    if missing:
+        rows = [{"name": name, "category_id": category_id} for name in sorted(missing)]
+        insert = dialect_insert()
+        if insert is not None:
+            db.session.execute(insert(Tag).values(rows).on_conflict_do_nothing())
+        else:
+            db.session.execute(db.insert(Tag).values(rows))
+        tag_ids.update(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(missing)).all())
+    return tag_ids
 
-    filename = os.path.join("static/media/samps", filename)
-    temp = os.path.join("static/media/samps", temp)
+def set_sample_tags(tag_ids_by_sample):
+    """Replaces the tags of several samples, given {sample_id: set of tag ids}.
 
-    probe = ffmpeg.probe(filename)
-    video_stream = next(
-        (stream for stream in probe["streams"] if stream["codec_type"] == "video"), None
+    Only the difference to what's stored is written, with one DELETE and one multi-row INSERT.
+    The samples' tags relationship isn't refreshed until the session is committed or expired.
+    """
+    if not tag_ids_by_sample:
+        return
+    current = set(
+        db.session.query(tags_table.c.sample_id, tags_table.c.tag_id)
+        .filter(tags_table.c.sample_id.in_(tag_ids_by_sample.keys()))
+        .all()
     )
+    wanted = {(sample_id, tag_id) for sample_id, tag_ids in tag_ids_by_sample.items() for tag_id in tag_ids}
+    removed = current - wanted
+    added = wanted - current
+    if removed:
+        db.session.execute(
+            tags_table.delete().where(tuple_(tags_table.c.sample_id, tags_table.c.tag_id).in_(sorted(removed)))
+        )
+    if added:
+        db.session.execute(
+            tags_table.insert().values([{"sample_id": sample_id, "tag_id": tag_id} for sample_id, tag_id in sorted(added)])
+        )
+    changed = sorted({sample_id for sample_id, _ in removed | added})
+    if changed:
+        db.session.execute(
+            db.update(Sample)
+            .where(Sample.id.in_(changed))
+            .values(updated_at=datetime.datetime.now(datetime.UTC))
+            .execution_options(synchronize_session=False)
+        )
 
-    width = int(video_stream.get("width"))
-    height = int(video_stream.get("height"))
-
-    sar = video_stream.get("sample_aspect_ratio")
-    if not sar or sar == "0:1":
-        sar = f"{width}:{height}"
-    else:
-        sar = sar
-
+def add_tag_to_db(name, category_id):
     try:
-        (
-            ffmpeg.input(filename)
-            .output(
-                temp,
-                format="mp4",
-                vcodec="libx264",
-                acodec="aac",
-                strict="experimental",
-                preset="medium",
-                vf=f"scale={width}:{height},setsar={sar},setdar={width}/{height}",
-            )
-            .run(overwrite_output=True)
-        )
-        os.replace(temp, filename)
-        return True
+        tag = Tag(name=name, category_id=category_id)
+        db.session.add(tag)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error adding tag: {e}")
+        raise
+
 
-    except ffmpeg.Error as e:
-        print(e.stderr)
-        return False
 
 def check_video(upload_path):
     try:
-        ffmpeg.probe(upload_path)
+        probe_video(upload_path)
         return True
     except ffmpeg.Error as ex:
         print(ex)
@@ -160,7 +295,61 @@ def get_metadata(sample_id):
     sample = Sample.query.get(sample_id)
     file = os.path.join("static/media/samps", sample.stored_as)
 
-    probe = ffmpeg.probe(file)
+    return probe_video(file)
+
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def perceptual_hash(image_path):
+    """64 bit difference hash of an image as a hex string, close images give hashes a few bits apart."""
+    try:
+        with metrics.ffmpeg_timer("perceptual_hash"):
+            pixels, _ = (
+                ffmpeg.input(image_path)
+                .filter("scale", 9, 8)
+                .output("pipe:", format="rawvideo", pix_fmt="gray", vframes=1)
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+    except (ffmpeg.Error, OSError) as e:
+        print(f"Couldn't hash {image_path}: {e}")
+        return None
+    if len(pixels) < 72:
+        return None
+
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
 
-    return probe
+def find_near_duplicates(max_distance=6):
+    """Groups samples whose thumbnails look alike, hashing any that haven't been yet. Meant for moderators, not requests."""
+    samples = Sample.query.order_by(Sample.id).all()
+    for sample in samples:
+        if sample.perceptual_hash is None:
+            sample.perceptual_hash = perceptual_hash(os.path.join("static/media/thumbs", sample.thumbnail_filename))
+    db.session.commit()
 
+    hashed = [(sample, int(sample.perceptual_hash, 16)) for sample in samples if sample.perceptual_hash]
+    groups = []
+    seen = set()
+    for i, (sample, phash) in enumerate(hashed):
+        if sample.id in seen:
+            continue
+        group = [sample]
+        for other, other_phash in hashed[i + 1:]:
+            # exact copies are already deduplicated by content_hash, skip those
+            if other.id in seen or other.stored_as == sample.stored_as:
+                continue
+            if bin(phash ^ other_phash).count("1") <= max_distance:
+                group.append(other)
+                seen.add(other.id)
+        if len(group) > 1:
+            groups.append(group)
+    return groups
@@ -1,21 +1,124 @@
 import os
+import threading
+from collections import namedtuple
+
 from flask import render_template
 import markdown
 
+WIKI_DIR = "static/wiki/pages"
+CHANGELOG_DIR = os.path.join(WIKI_DIR, "changelogs")
+# where `flask build-wiki` writes the rendered pages, mirroring WIKI_DIR
+PREBUILT_DIR = "static/wiki/rendered"
+WIKI_EXTENSIONS = ["tables", "md_in_html"]
 
-def wiki_main():
-    return render_template("wiki/wiki_home.html")
+RenderedPage = namedtuple("RenderedPage", ["title", "html", "mtime_ns"])
 
-def wiki_page(page):
-    filepath = os.path.join("static/wiki/pages", f"{page}.md")
 
-    with open(filepath, "r", encoding="utf-8") as f:
-        md_content = f.read()
+class PageCache:
+    """Rendered markdown files of one directory, keyed by slug and re-rendered only when a file's mtime changes.
+
+    The listing of the directory is kept too, so an unknown slug is a 404 without touching the file.
+    """
+
+    def __init__(self, directory, extensions):
+        self.directory = directory
+        self.extensions = extensions
+        self.pages = {}
+        self.listing = set()
+        self.listing_mtime = None
+        self.lock = threading.Lock()
+
+    def _path(self, slug):
+        return os.path.join(self.directory, f"{slug}.md")
+
+    def _prebuilt_path(self, slug):
+        return os.path.join(PREBUILT_DIR, os.path.relpath(self.directory, WIKI_DIR), f"{slug}.html")
+
+    def slugs(self):
+        # one stat per lookup, the directory is only listed again when something is added or removed
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return set()
+        with self.lock:
+            if mtime != self.listing_mtime:
+                self.listing = {name[:-3] for name in os.listdir(self.directory) if name.endswith(".md")}
+                self.listing_mtime = mtime
+            return self.listing
+
+    def get(self, slug):
+        """Returns the RenderedPage for slug, or None if there's no such page."""
+        if slug not in self.slugs():
+            return None
+        try:
+            mtime = os.stat(self._path(slug)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        page = self.pages.get(slug)
+        if page is None or page.mtime_ns != mtime:
+            page = self._render(slug, mtime)
+            with self.lock:
+                self.pages[slug] = page
+        return page
+
+    def _render(self, slug, mtime):
+        with open(self._path(slug), "r", encoding="utf-8") as f:
+            md_content = f.read()
+        title = md_content.split("\n")[0][2:]
+
+        # a prebuilt page is only used if it was built from this exact version of the file
+        prebuilt = self._prebuilt_path(slug)
+        try:
+            if os.stat(prebuilt).st_mtime_ns == mtime:
+                with open(prebuilt, "r", encoding="utf-8") as f:
+                    return RenderedPage(title, f.read(), mtime)
+        except FileNotFoundError:
+            pass
+
+        return RenderedPage(title, markdown.markdown(md_content, extensions=self.extensions), mtime)
 
-    title = md_content.split("\n")[0][2:]
+    def prerender(self):
+        for slug in self.slugs():
+            self.get(slug)
 
-    html_content = markdown.markdown(md_content, extensions=["tables", "md_in_html"])
+    def build(self):
+        """Writes every page to PREBUILT_DIR, stamped with the mtime of its source. Returns the number of pages."""
+        self.prerender()
+        os.makedirs(os.path.dirname(self._prebuilt_path("_")), exist_ok=True)
+        for slug, page in list(self.pages.items()):
+            prebuilt = self._prebuilt_path(slug)
+            with open(prebuilt, "w", encoding="utf-8") as f:
+                f.write(page.html)
+            os.utime(prebuilt, ns=(page.mtime_ns, page.mtime_ns))
+        return len(self.pages)
+
+
+pages = PageCache(WIKI_DIR, WIKI_EXTENSIONS)
+changelogs = PageCache(CHANGELOG_DIR, [])
+
+
+def changelog(version):
+    """Rendered changelog html for version, or None if there isn't one."""
+    page = changelogs.get(version)
+    return page.html if page else None
+
+
+def wiki_main():
+    return render_template("wiki/wiki_home.html")
+
+def wiki_page(page):
+    rendered = pages.get(page)
+    if rendered is None:
+        return render_template("404.html", title="YTPMVSD Wiki"), 404
 
     return render_template(
-        "wiki/wiki_page.html", content=html_content, title=title + " - YTPMVSD Wiki"
+        "wiki/wiki_page.html", content=rendered.html, title=rendered.title + " - YTPMVSD Wiki"
     )
+
+def build():
+    return pages.build() + changelogs.build()
+
+def init_app(app):
+    # render everything once up front so the first visitors don't pay for it
+    pages.prerender()
+    changelogs.prerender()